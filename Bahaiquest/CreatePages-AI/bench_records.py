@@ -0,0 +1,69 @@
+r"""
+Memory benchmark: per-paragraph overhead of workspace records held as plain dicts
+(as json.loads returns them) versus records.Quote objects.
+
+The records are synthetic but shaped like a large keyword: a few dozen source titles
+repeated over many paragraphs, unique locations, and 64-character paragraph store hashes.
+No network access or API keys are needed.
+
+Usage: python bench_records.py [paragraph_count]
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modules'))
+import records
+
+TITLE_COUNT = 40
+
+def sample_lines(count):
+    """JSON Lines as they appear in a workspace file (paragraph store references)."""
+    lines = []
+    for i in range(count):
+        record = {
+            "title": f"Selections from the Writings of Source Number {i % TITLE_COUNT}",
+            "location": f"/library/author/source-{i % TITLE_COUNT}/{i:07d}/1#r=ins-{i}",
+            "hash": hashlib.sha256(str(i).encode('utf-8')).hexdigest(),
+        }
+        lines.append(json.dumps(record, ensure_ascii=False))
+    return lines
+
+def measure(lines, parse):
+    """Returns (records, bytes retained, seconds). Timing is taken without tracemalloc, which slows allocation."""
+    start = time.perf_counter()
+    loaded = [parse(line) for line in lines]
+    elapsed = time.perf_counter() - start
+    del loaded
+
+    tracemalloc.start()
+    loaded = [parse(line) for line in lines]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return loaded, current, elapsed
+
+def main(count):
+    lines = sample_lines(count)
+
+    dicts, dict_bytes, dict_seconds = measure(lines, json.loads)
+    del dicts
+    quotes, quote_bytes, quote_seconds = measure(lines, records.Quote.from_json)
+
+    start = time.perf_counter()
+    round_trip = [quote.to_json() for quote in quotes]
+    serialize_seconds = time.perf_counter() - start
+    assert round_trip == lines
+
+    print(f"{count} paragraph references")
+    print(f"{'Record type':<14}{'Bytes/paragraph':>17}{'Load time':>12}")
+    print(f"{'dict':<14}{dict_bytes / count:>17.0f}{dict_seconds:>11.2f}s")
+    print(f"{'Quote':<14}{quote_bytes / count:>17.0f}{quote_seconds:>11.2f}s")
+    print(f"\nQuote records use {1 - quote_bytes / dict_bytes:.0%} less memory per paragraph.")
+    print(f"Serializing {count} Quote records back to JSON Lines took {serialize_seconds:.2f}s.")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
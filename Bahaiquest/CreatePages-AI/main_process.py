@@ -1,14 +1,21 @@
 r"""
-Usage: python main_process.py <keyword>
+Usage: python main_process.py <keyword> [--plan | --refresh] [--profile]
+
+  --plan      Estimate API calls, tokens, cost and wall time for the keyword without running it
+  --refresh   Re-search the keyword and only categorize and distill new or changed paragraphs
+  --profile   Write CPU, memory and network-wait reports for every stage (or for --plan) to
+              workspace/<keyword>/profile
 """
 
 import os
 import sys
-import subprocess
+import argparse
+import contextlib
+import traceback
 from dotenv import load_dotenv
 
 # Import our custom modules
-from modules import categorize_quotes, distill_quotes, format_wiki, validate_quotes
+from modules import cassette, search_library, dedup_quotes, categorize_quotes, distill_quotes, format_wiki, validate_quotes, planner, refresh, profiling
 
 # --- NEW: Helper function to print to console AND log file ---
 def log_and_print(message, log_file):
@@ -17,82 +24,137 @@ def log_and_print(message, log_file):
     log_file.write(message + '\n')
     log_file.flush() # Ensure the message is written immediately
 
-def main(keyword):
-    # --- Setup Logging ---
-    log_dir = 'logs'
-    os.makedirs(log_dir, exist_ok=True)
-    log_file_path = os.path.join(log_dir, f'{keyword}.log')
-
-    # Open the log file for the entire duration of the workflow
-    with open(log_file_path, 'w', encoding='utf-8') as log_file:
-        log_and_print(f"========= STARTING HYBRID WORKFLOW FOR KEYWORD: '{keyword}' =========", log_file)
-        log_and_print("Using Gemini for Categorization and ChatGPT for Distillation.", log_file)
-        log_and_print(f"Detailed output will be saved to: {log_file_path}", log_file)
-        load_dotenv()
-
-        KEYWORD_DIR = os.path.join('workspace', keyword)
-        os.makedirs(KEYWORD_DIR, exist_ok=True)
-
-        # --- Step 1: Search the Library ---
-        search_script_path = 'modules/search_library.py'
-        log_and_print(f"\n----- Step 1: Running Search -----", log_file)
+# The pipeline stages, in order. Each one reads the previous stage's files from the
+# keyword's workspace, so they can also be run one at a time (see queue_worker.py).
+STAGES = ['search', 'dedup', 'categorize', 'distill', 'format', 'validate']
+
+STAGE_TITLES = {
+    'search': "Step 1: Running Search",
+    'dedup': "Step 1b: Collapsing Duplicate Paragraphs",
+    'categorize': "Step 2: Categorizing with Gemini",
+    'distill': "Step 3: Distilling with {distill_model}",
+    'format': "Step 4: Formatting Final Wiki Output",
+    'validate': "Step 5: Validating Excerpts Against Originals",
+}
+
+def run_stage(stage, keyword, log_file, log_file_path, refresh_mode=False):
+    """Runs a single pipeline stage for a keyword. refresh_mode only processes what changed since the last run."""
+    KEYWORD_DIR = os.path.join('workspace', keyword)
+    os.makedirs(KEYWORD_DIR, exist_ok=True)
+    # Recorded search and AI traffic is kept per keyword (see modules/cassette.py)
+    cassette.use(keyword)
+
+    # DISTILL_MODEL picks the distillation model: ChatGPT (default), Gemini, or Auto (model_router.py)
+    distill_model = distill_quotes.configured_model()
+    log_and_print(f"\n----- {STAGE_TITLES[stage].format(distill_model=distill_model)} -----", log_file)
+
+    if stage == 'search':
         try:
-            # Redirect stdout and stderr of the subprocess directly to the log file
-            # This will capture all the 'print' statements from search_library.py
-            subprocess.run(
-                ['python', search_script_path, keyword, KEYWORD_DIR],
-                check=True,
-                stdout=log_file,            # Send standard output to the log file
-                stderr=subprocess.STDOUT    # Merge standard error into standard output
-            )
+            previous = refresh.snapshot(KEYWORD_DIR, keyword) if refresh_mode else None
+            # Run the search in-process, capturing all its 'print' output in the log file
+            with contextlib.redirect_stdout(log_file):
+                # A refresh must see the library as it is now, not as cached
+                search_library.run(keyword, KEYWORD_DIR, max_cache_age_hours=0 if refresh_mode else None)
             log_and_print("----- Search Complete -----", log_file)
-        except FileNotFoundError:
-            log_and_print(f"!!! ERROR: Search script not found at '{search_script_path}'.", log_file)
-            sys.exit(1)
-        except subprocess.CalledProcessError as e:
-            # The error details are already in the log file because we redirected stderr
-            log_and_print(f"!!! ERROR: Your search script failed with a non-zero exit code: {e.returncode}", log_file)
+            if refresh_mode:
+                changes = refresh.diff(previous, refresh.snapshot(KEYWORD_DIR, keyword))
+                diff_path = refresh.write_diff(KEYWORD_DIR, changes)
+                log_and_print(f"Refresh: {len(changes['new'])} new, {len(changes['changed'])} changed, "
+                              f"{len(changes['removed'])} removed, {changes['unchanged']} unchanged paragraphs "
+                              f"(details in {diff_path}).", log_file)
+        except Exception:
+            log_file.write(traceback.format_exc())
+            log_and_print("!!! ERROR: The search step failed.", log_file)
             log_and_print(f"!!! Check '{log_file_path}' for detailed error messages.", log_file)
             sys.exit(1)
 
-        # --- Subsequent Steps ---
-        # NOTE: The output from these imported modules will still print to the console
-        # unless they are also modified to accept a log_file object.
-        # For now, only their status messages from this script are logged.
+    # NOTE: The output from the other modules still prints to the console
+    # unless they are also modified to accept a log_file object.
+    # For now, only their status messages from this script are logged.
+
+    elif stage == 'dedup':
+        clusters = dedup_quotes.run(KEYWORD_DIR, keyword)
+        log_and_print(f"Found {len(clusters)} duplicate clusters; only their representatives go to the AI models.", log_file)
 
-        log_and_print("\n----- Step 2: Categorizing with Gemini -----", log_file)
-        categorize_quotes.run(KEYWORD_DIR, KEYWORD_DIR, keyword, model_name='Gemini', log_file=log_file)
+    elif stage == 'categorize':
+        categorize_quotes.run(KEYWORD_DIR, KEYWORD_DIR, keyword, model_name='Gemini', log_file=log_file,
+                              refresh=refresh_mode)
 
-        log_and_print("\n----- Step 3: Distilling with ChatGPT -----", log_file)
+    elif stage == 'distill':
+        # Excerpts are cached per paragraph in the paragraph store, so unchanged paragraphs
+        # (always, not only in a refresh) are not sent to the model again
         distill_quotes.run(
             input_dir=KEYWORD_DIR,
             output_dir=KEYWORD_DIR,
             keyword=keyword,
-            model_name='ChatGPT',
+            model_name=distill_model,
             source_model_name='Gemini'
         )
 
-        log_and_print("\n----- Step 4: Formatting Final Wiki Output -----", log_file)
+    elif stage == 'format':
         format_wiki.run(
             input_dir=KEYWORD_DIR,
             final_output_file=f'final_output_{keyword}.txt',
-            model_suffix='_final_for_wiki-ChatGPT.txt'
+            model_suffix=f'_final_for_wiki-{distill_model}.txt'
         )
 
-        log_and_print("\n----- Step 5: Validating Excerpts Against Originals -----", log_file)
+    elif stage == 'validate':
         validate_quotes.run(keyword)
 
+    else:
+        raise ValueError(f"Unknown stage '{stage}'. Choose one of: {', '.join(STAGES)}")
+
+def main(keyword, refresh_mode=False, profile=False):
+    # --- Setup Logging ---
+    log_dir = 'logs'
+    os.makedirs(log_dir, exist_ok=True)
+    log_file_path = os.path.join(log_dir, f'{keyword}.log')
+
+    # Open the log file for the entire duration of the workflow
+    with open(log_file_path, 'w', encoding='utf-8') as log_file:
+        log_and_print(f"========= STARTING HYBRID WORKFLOW FOR KEYWORD: '{keyword}' =========", log_file)
+        log_and_print(f"Detailed output will be saved to: {log_file_path}", log_file)
+        load_dotenv()
+        log_and_print(f"Using Gemini for Categorization and {distill_quotes.configured_model()} for Distillation.", log_file)
+        if cassette.mode() != 'off':
+            log_and_print(f"Cassette mode '{cassette.mode()}': traffic is {'served from' if cassette.replaying() else 'recorded to'} the keyword's cassette.", log_file)
+
+        if refresh_mode:
+            log_and_print("Refresh mode: only new or changed paragraphs are categorized and distilled.", log_file)
+
+        profiler = profiling.Profiler(keyword, enabled=profile)
+        if profile:
+            log_and_print(f"Profiling enabled: reports are written to {profiler.directory}", log_file)
+
+        for stage in STAGES:
+            with profiler.stage(stage):
+                run_stage(stage, keyword, log_file, log_file_path, refresh_mode)
+
         log_and_print(f"\n========= WORKFLOW COMPLETE FOR '{keyword}' =========", log_file)
-        print(f"All intermediate files are in: {KEYWORD_DIR}")
+        print(f"All intermediate files are in: {os.path.join('workspace', keyword)}")
         print(f"Final validated output is in: final_output_{keyword}.txt")
         print(f"Full execution log is available at: {log_file_path}")
+        if profile:
+            print(f"Profiling reports are in: {profiler.directory}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python main_process.py <keyword>")
-        sys.exit(1)
-
-    search_keyword = sys.argv[1].lower()
-    main(search_keyword)
-
+    parser = argparse.ArgumentParser(description="Run the full CreatePages-AI pipeline for a keyword.")
+    parser.add_argument('keyword')
+    parser.add_argument('--plan', action='store_true',
+                        help="Only estimate API calls, tokens, cost and wall time; make no paid calls")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Re-search, then only categorize and distill new or changed paragraphs")
+    parser.add_argument('--profile', action='store_true',
+                        help="Write per-stage (or --plan) cProfile, tracemalloc and network-wait reports to workspace/<keyword>/profile")
+    args = parser.parse_args()
+
+    search_keyword = args.keyword.lower()
+    if args.plan:
+        load_dotenv()
+        cassette.use(search_keyword)
+        profiler = profiling.Profiler(search_keyword, enabled=args.profile)
+        with profiler.stage('plan'):
+            planner.plan(search_keyword)
+    else:
+        main(search_keyword, refresh_mode=args.refresh, profile=args.profile)
@@ -2,14 +2,27 @@
 import os
 import json
 import time
+import hashlib
+import datetime
+import threading
 import openai
 import google.generativeai as genai
 import sys
 
+try:
+    from . import cassette
+except ImportError:
+    import cassette
+
 # --- Prompts ---
 
-DISTILLATION_PROMPT = """
-You are an expert theological archivist specializing in the Baha'i Faith. Your task is to create an excerpt for a specific keyword from a given paragraph.
+# The distillation prompt is split into a static instruction prefix and a short per-call
+# suffix. The prefix must stay byte-identical between calls (no formatting placeholders),
+# so providers can serve it from their prompt cache: it is sent as the OpenAI system message
+# (automatic prompt caching) and as the Gemini cached content / system instruction.
+# Both providers only cache prefixes of at least PROMPT_CACHE_MIN_TOKENS; this prefix is
+# about 250 tokens, so nothing is cached yet. The layout is ready for when it grows.
+DISTILLATION_SYSTEM_PROMPT = """You are an expert theological archivist specializing in the Baha'i Faith. Your task is to create an excerpt for a specific keyword from a given paragraph.
 
 Rules:
 1. The excerpt must contain the keyword
@@ -19,8 +32,9 @@ Rules:
 5. Do not start the excerpt with an ellipses. Do not end an excerpt with an ellipses
 6. If necessary context exists separate from the keyword or the main idea, remove the irrelevant content and annotate this removal with an ellipses
 7. Do NOT add any commentary, explanation, or quotation marks around your response. Return only the excerpt.
+"""
 
-Keyword: "{keyword}"
+DISTILLATION_USER_PROMPT = """Keyword: "{keyword}"
 
 Paragraph:
 "{paragraph}"
@@ -28,6 +42,15 @@ Paragraph:
 Distilled Excerpt:
 """
 
+# Default distillation models. Cached excerpts are keyed by the model that produced them.
+CHATGPT_DISTILL_MODEL = "gpt-4-turbo"
+GEMINI_DISTILL_MODEL = "gemini-2.5-flash"
+
+def distillation_prompt_hash():
+    """Short hash of the distillation prompts, so excerpts cached under an older prompt are not reused."""
+    prompts = DISTILLATION_SYSTEM_PROMPT + DISTILLATION_USER_PROMPT
+    return hashlib.sha256(prompts.encode('utf-8')).hexdigest()[:12]
+
 CATEGORIZATION_PROMPT = """
 You are an expert theological archivist specializing in the Baha'i Faith. Your task is to analyze a list of full paragraphs, all containing the keyword "{keyword}", and group them by thematic category based on their context.
 
@@ -38,115 +61,367 @@ Rules:
 2. Create a short, descriptive summary for each theme (e.g., "The role of just government", "Opposition from governments") using sentence case.
 3. Assign each quote to EXACTLY ONE descriptive category that best describes it.
 4. If a paragraph does not fit into ANY of the categories you identified, assign it to "Uncategorized".
-5. The input is a JSON array of objects, where each object has a unique "location" and the full "quote" paragraph.
-6. On each new line return one category followed by all matching "location" identifiers. NO spaces NO commas NO seperators between location identifers.
-7. Do not return any other content.
+5. The input is a JSON array of objects, where each object has a unique "id" and the full "quote" paragraph.
+6. Return a JSON object with a "categories" array. Each entry has the category "name" and the "ids" of all matching paragraphs.
+7. Every id must appear exactly once. Do not return any other content.
 
 Example Output Format:
 
-Category Name A:a1b7
-Category Name B:a2
-Uncategorized:a3
+{{"categories": [{{"name": "Category Name A", "ids": ["a1", "b7"]}}, {{"name": "Category Name B", "ids": ["a2"]}}, {{"name": "Uncategorized", "ids": ["a3"]}}]}}
+
+Here is the list of paragraphs to categorize:
+{quotes_json}
+"""
+
+# Follow-up request for paragraphs the first response left out (or assigned ambiguously).
+# Only those paragraphs are sent, together with the categories already established.
+CATEGORIZATION_FOLLOWUP_PROMPT = """
+You are an expert theological archivist specializing in the Baha'i Faith. The paragraphs below all contain the keyword "{keyword}". Other paragraphs with this keyword have already been grouped into these thematic categories:
+
+{categories_json}
+
+IMPORTANT: The following paragraphs are direct quotes from the Baha'i Faith's religious scriptures and historical texts. They must be analyzed strictly within their theological and historical context.
+
+Rules:
+1. Assign each paragraph to EXACTLY ONE of the categories above, using its name exactly as written.
+2. If a paragraph does not fit into ANY of them, assign it to "Uncategorized". Do not create new categories.
+3. The input is a JSON array of objects, where each object has a unique "id" and the full "quote" paragraph.
+4. Return a JSON object with a "categories" array. Each entry has the category "name" and the "ids" of all matching paragraphs.
+5. Every id must appear exactly once. Do not return any other content.
+
+Here is the list of paragraphs to categorize:
+{quotes_json}
+"""
+
+# Continuation after an interrupted response: the categories seen so far may be incomplete,
+# so they are suggestions and the model may still add the themes it has not named yet.
+CATEGORIZATION_CONTINUATION_PROMPT = """
+You are an expert theological archivist specializing in the Baha'i Faith. The paragraphs below all contain the keyword "{keyword}". Other paragraphs with this keyword have already been grouped into these thematic categories, but the list may not be complete yet:
+
+{categories_json}
+
+IMPORTANT: The following paragraphs are direct quotes from the Baha'i Faith's religious scriptures and historical texts. They must be analyzed strictly within their theological and historical context.
+
+Rules:
+1. Assign each paragraph to EXACTLY ONE category. Prefer the categories above, using their names exactly as written.
+2. If several paragraphs share a recurring theme that none of the categories above describes, create a new short, descriptive category for it in sentence case. Together with the categories above there should be between 5 and 16.
+3. If a paragraph does not fit into ANY category, assign it to "Uncategorized".
+4. The input is a JSON array of objects, where each object has a unique "id" and the full "quote" paragraph.
+5. Return a JSON object with a "categories" array. Each entry has the category "name" and the "ids" of all matching paragraphs.
+6. Every id must appear exactly once. Do not return any other content.
 
 Here is the list of paragraphs to categorize:
 {quotes_json}
 """
 
+def categorization_prompt(quotes_with_ids, keyword, categories=None, allow_new_categories=False):
+    """
+    Builds the full categorization prompt, or, when `categories` is given, the follow-up
+    prompt (only those categories) or, with allow_new_categories, the continuation prompt.
+    """
+    quotes_json = json.dumps(quotes_with_ids, indent=2)
+    if categories:
+        template = CATEGORIZATION_CONTINUATION_PROMPT if allow_new_categories else CATEGORIZATION_FOLLOWUP_PROMPT
+        return template.format(
+            keyword=keyword, categories_json=json.dumps(categories + ['Uncategorized'], indent=2), quotes_json=quotes_json)
+    return CATEGORIZATION_PROMPT.format(keyword=keyword, quotes_json=quotes_json)
+
+def categorization_schema(categories=None, strict=False):
+    """
+    JSON schema of the categorization response. With `categories`, names are restricted to
+    that list (plus "Uncategorized"). strict=True adds the keywords OpenAI's strict
+    structured outputs require; Gemini's response_schema does not accept them.
+    """
+    name_schema = {"type": "string"}
+    if categories:
+        name_schema["enum"] = categories + ['Uncategorized']
+    category_schema = {
+        "type": "object",
+        "properties": {"name": name_schema, "ids": {"type": "array", "items": {"type": "string"}}},
+        "required": ["name", "ids"],
+    }
+    schema = {
+        "type": "object",
+        "properties": {"categories": {"type": "array", "items": category_schema}},
+        "required": ["categories"],
+    }
+    if strict:
+        category_schema["additionalProperties"] = False
+        schema["additionalProperties"] = False
+    return schema
+
+# --- Prompt cache accounting ---
+# Token counts reported by the providers, so the effect of prompt caching can be checked.
+CACHE_STATS = {
+    "chatgpt": {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0},
+    "gemini": {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0},
+}
+
+# distill_concurrently() calls the providers from several threads; this lock guards
+# CACHE_STATS and the client/model registries below
+_lock = threading.Lock()
+
+def _record_usage(provider, prompt_tokens, cached_tokens):
+    with _lock:
+        stats = CACHE_STATS[provider]
+        stats["calls"] += 1
+        stats["prompt_tokens"] += prompt_tokens or 0
+        stats["cached_tokens"] += cached_tokens or 0
+
+def cache_stats_summary():
+    """Human-readable summary of cached vs. total prompt tokens per provider."""
+    lines = ["Prompt cache usage:"]
+    if not prefix_is_cacheable(DISTILLATION_SYSTEM_PROMPT):
+        lines[0] += (f" (the distillation prefix is below the providers' {PROMPT_CACHE_MIN_TOKENS}-token"
+                     f" caching minimum, so no tokens are expected from cache)")
+    with _lock:
+        snapshot = {provider: dict(stats) for provider, stats in CACHE_STATS.items()}
+    for provider, stats in snapshot.items():
+        if not stats["calls"]:
+            continue
+        ratio = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        lines.append(f"  {provider}: {stats['calls']} calls, {stats['cached_tokens']}/{stats['prompt_tokens']} "
+                     f"prompt tokens served from cache ({ratio:.0%})")
+    return "\n".join(lines)
+
+# --- Low-level provider calls ---
+# These make exactly one request and let exceptions propagate, so callers
+# (the retry loops below, or modules/model_router.py) decide how to react.
+
+PROMPT_CACHE_KEY = "bahaiquest-distillation-v1"
+GEMINI_CACHE_TTL = datetime.timedelta(hours=1)
+# OpenAI automatic caching and Gemini explicit caching both need a prefix of at least this size
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+_gemini_models = {}
+_openai_clients = {}
+
+def _openai_client():
+    """One OpenAI client per API key, reused so its HTTP connection pool stays warm."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    with _lock:
+        if api_key not in _openai_clients:
+            _openai_clients[api_key] = openai.OpenAI(api_key=api_key)
+        return _openai_clients[api_key]
+
+def prefix_is_cacheable(system):
+    """Rough check (about 4 characters per token) that a prefix reaches the providers' caching minimum."""
+    return len(system) // 4 >= PROMPT_CACHE_MIN_TOKENS
+
+def _gemini_model(model, system=None):
+    """
+    Returns a GenerativeModel for `model`, reused across calls. With a system prompt large
+    enough to cache, an explicit cached-content handle is created so the prefix is billed at
+    the cached rate; the handle is recreated shortly before its TTL runs out, so a
+    long-running process (the worker daemon) never calls an expired cache. A smaller prefix,
+    or one the provider refuses to cache, is sent as a plain system instruction.
+
+    Runs under the module lock, so concurrent callers never create a second cached content.
+    """
+    with _lock:
+        return _gemini_model_locked(model, system)
+
+def _gemini_model_locked(model, system):
+    key = (model, system)
+    if key in _gemini_models:
+        generative_model, expires_at = _gemini_models[key]
+        if expires_at is None or time.time() < expires_at:
+            return generative_model
+
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    expires_at = None
+    if system is None:
+        generative_model = genai.GenerativeModel(model)
+    elif not prefix_is_cacheable(system):
+        generative_model = genai.GenerativeModel(model, system_instruction=system)
+    else:
+        try:
+            cached = genai.caching.CachedContent.create(
+                model=f"models/{model}",
+                display_name=PROMPT_CACHE_KEY,
+                system_instruction=system,
+                ttl=GEMINI_CACHE_TTL,
+            )
+            generative_model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+            # A minute's margin, so no request is still in flight when the cache expires
+            expires_at = time.time() + GEMINI_CACHE_TTL.total_seconds() - 60
+            print(f"  > Created Gemini context cache {cached.name} for {model}.")
+        except Exception as e:
+            print(f"  > Gemini context cache unavailable for {model} ({e}); using system instruction.")
+            generative_model = genai.GenerativeModel(model, system_instruction=system)
+
+    _gemini_models[key] = (generative_model, expires_at)
+    return generative_model
+
+def call_chatgpt(prompt, model="gpt-4-turbo", system=None):
+    """Sends a single prompt (with an optional cacheable system prefix) to OpenAI and returns the stripped response text."""
+    def live():
+        client = _openai_client()
+        messages = [{"role": "user", "content": prompt}]
+        extra = {}
+        if system is not None:
+            messages.insert(0, {"role": "system", "content": system})
+            # Routes requests sharing the prefix to the same cache
+            extra["prompt_cache_key"] = PROMPT_CACHE_KEY
+        response = client.chat.completions.create(model=model, messages=messages, **extra)
+
+        usage = response.usage
+        details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+        _record_usage("chatgpt", usage.prompt_tokens if usage else 0, getattr(details, 'cached_tokens', 0) if details else 0)
+        return response.choices[0].message.content.strip()
+
+    return cassette.call('chatgpt', {"model": model, "system": system, "prompt": prompt}, live)
+
+def call_gemini(prompt, model="gemini-2.5-flash", system=None):
+    """Sends a single prompt (with an optional cacheable system prefix) to Gemini and returns the stripped response text."""
+    def live():
+        response = _gemini_model(model, system).generate_content(prompt)
+
+        usage = getattr(response, 'usage_metadata', None)
+        _record_usage("gemini", getattr(usage, 'prompt_token_count', 0), getattr(usage, 'cached_content_token_count', 0))
+        return response.text.strip()
+
+    return cassette.call('gemini', {"model": model, "system": system, "prompt": prompt}, live)
+
+def distillation_prompts(keyword, paragraph):
+    """Returns (system_prefix, user_suffix) for a distillation call."""
+    return DISTILLATION_SYSTEM_PROMPT, DISTILLATION_USER_PROMPT.format(keyword=keyword, paragraph=paragraph)
+
+def is_throttle_error(error):
+    """Returns True if an API exception means 'slow down' rather than 'broken request'."""
+    if isinstance(error, openai.RateLimitError):
+        return True
+    status = getattr(error, 'status_code', None) or getattr(error, 'code', None)
+    if status == 429:
+        return True
+    text = str(error).lower()
+    return '429' in text or 'resource exhausted' in text or 'rate limit' in text or 'quota' in text
+
 # --- OpenAI (ChatGPT) Functions ---
-def distill_with_chatgpt(paragraph, keyword, max_retries=3):
-    # This function is unchanged
-    print(f"  > Distilling with ChatGPT...")
+def distill_with_chatgpt(paragraph, keyword, max_retries=3, model=CHATGPT_DISTILL_MODEL):
+    print(f"  > Distilling with ChatGPT ({model})...")
+    system, prompt = distillation_prompts(keyword, paragraph)
     for attempt in range(max_retries):
         try:
-            client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            response = client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "user", "content": DISTILLATION_PROMPT.format(keyword=keyword, paragraph=paragraph)}
-                ]
-            )
-            return response.choices[0].message.content.strip()
+            return call_chatgpt(prompt, model=model, system=system)
+        except cassette.CassetteMiss:
+            # An unrecorded request fails the same way on every attempt
+            raise
         except Exception as e:
             print(f"    ! ChatGPT API error (Attempt {attempt + 1}/{max_retries}): {e}")
             time.sleep(5)
     return "[[ChatGPT distillation failed]]"
 
-def categorize_with_chatgpt(quotes_with_ids, keyword, log_file=None):
-    # (function signature changed to reflect 'ids' not 'locations')
-    print(f"  > Categorizing {len(quotes_with_ids)} full paragraphs with ChatGPT...")
-    quotes_json = json.dumps(quotes_with_ids, indent=2)
-    prompt = CATEGORIZATION_PROMPT.format(keyword=keyword, quotes_json=quotes_json)
-
+def _log_categorization_request(prompt, provider, log_file=None):
+    """Writes the categorization prompt to the run log, or to a payload file when run manually."""
     # If a log file is provided by main_process.py, use it.
     if log_file:
-        log_file.write("\n" + "="*20 + " LOGGING CHATGPT API REQUEST " + "="*20 + "\n")
+        log_file.write("\n" + "="*20 + f" LOGGING {provider.upper()} API REQUEST " + "="*20 + "\n")
         log_file.write(prompt + "\n")
         log_file.write("="*24 + " END OF API REQUEST LOG " + "="*24 + "\n\n")
         log_file.flush()
     # Otherwise (when run manually), save the payload to a dedicated file.
     else:
-        with open('api_request_payload_chatgpt.txt', 'w', encoding='utf-8') as f:
+        with open(f'api_request_payload_{provider.lower()}.txt', 'w', encoding='utf-8') as f:
             f.write(prompt)
 
+def _fatal_categorization_error(provider, error, log_file=None):
+    # On any error, log it and terminate the entire script
+    error_message = f"!!! FATAL {provider} API Error: {error}\nTerminating script."
+    print(f"    ! {error_message}")
+    if log_file:
+        log_file.write(error_message + '\n')
+    sys.exit(1)
+
+def categorize_with_chatgpt(quotes_with_ids, keyword, log_file=None, stream=False, categories=None,
+                            allow_new_categories=False):
+    """
+    Sends paragraphs to ChatGPT for categorization, constrained to the JSON schema from
+    categorization_schema(). With `categories`, this is a follow-up request that may only
+    use those (already established) category names, or, with allow_new_categories, a
+    continuation that is offered them as suggestions but may add new ones.
+
+    With stream=False, returns the full raw text (and terminates the script on error).
+    With stream=True, returns an iterator of text chunks as they are generated; errors
+    are raised from the iterator so the caller can keep whatever arrived before the break.
+    """
+    print(f"  > Categorizing {len(quotes_with_ids)} full paragraphs with ChatGPT...")
+    prompt = categorization_prompt(quotes_with_ids, keyword, categories, allow_new_categories)
+    _log_categorization_request(prompt, 'ChatGPT', log_file)
+    allowed_names = None if allow_new_categories else categories
+
+    messages = [{"role": "user", "content": prompt}]
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": "categorization", "strict": True,
+                        "schema": categorization_schema(allowed_names, strict=True)},
+    }
+
+    recorded_request = {"model": "gpt-4.1-mini", "prompt": prompt, "response_format": response_format}
+
+    if stream:
+        def chunks():
+            response = _openai_client().chat.completions.create(
+                model="gpt-4.1-mini", messages=messages, response_format=response_format, stream=True)
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        return cassette.stream('chatgpt-categorize', recorded_request, chunks)
+
     try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[{"role": "user", "content": prompt}],
-        )
         # Return the raw text content
-        return response.choices[0].message.content
+        return cassette.call('chatgpt-categorize', recorded_request, lambda: _openai_client().chat.completions.create(
+            model="gpt-4.1-mini", messages=messages, response_format=response_format).choices[0].message.content)
     except Exception as e:
-        # REVISED: On any error, log it and terminate the entire script
-        error_message = f"!!! FATAL ChatGPT API Error: {e}\nTerminating script."
-        print(f"    ! {error_message}")
-        if log_file:
-            log_file.write(error_message + '\n')
-        sys.exit(1)
+        _fatal_categorization_error('ChatGPT', e, log_file)
 
 # --- Google (Gemini) Functions ---
-def distill_with_gemini(paragraph, keyword, max_retries=3):
-    # This function is unchanged
-    print(f"  > Distilling with Gemini...")
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-    model = genai.GenerativeModel('gemini-2.5-flash') # Updated to a more recent model
-    prompt = DISTILLATION_PROMPT.format(keyword=keyword, paragraph=paragraph)
+def distill_with_gemini(paragraph, keyword, max_retries=3, model=GEMINI_DISTILL_MODEL):
+    print(f"  > Distilling with Gemini ({model})...")
+    system, prompt = distillation_prompts(keyword, paragraph)
 
     for attempt in range(max_retries):
         try:
-            response = model.generate_content(prompt)
-            return response.text.strip()
+            return call_gemini(prompt, model=model, system=system)
+        except cassette.CassetteMiss:
+            # An unrecorded request fails the same way on every attempt
+            raise
         except Exception as e:
             print(f"    ! Gemini API error (Attempt {attempt + 1}/{max_retries}): {e}")
             time.sleep(5)
     return "[[Gemini distillation failed]]"
 
 
-def categorize_with_gemini(quotes_with_ids, keyword, log_file=None):
-    # (function signature changed to reflect 'ids' not 'locations')
+def categorize_with_gemini(quotes_with_ids, keyword, log_file=None, stream=False, categories=None,
+                           allow_new_categories=False):
+    """Gemini counterpart of categorize_with_chatgpt (same return contract)."""
     print(f"  > Categorizing {len(quotes_with_ids)} full paragraphs with Gemini...")
     genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
     model = genai.GenerativeModel('gemini-2.5-flash')
-    quotes_json = json.dumps(quotes_with_ids, indent=2)
-    prompt = CATEGORIZATION_PROMPT.format(keyword=keyword, quotes_json=quotes_json)
+    prompt = categorization_prompt(quotes_with_ids, keyword, categories, allow_new_categories)
+    _log_categorization_request(prompt, 'Gemini', log_file)
+    allowed_names = None if allow_new_categories else categories
+    generation_config = genai.GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=categorization_schema(allowed_names),
+    )
+
+    recorded_request = {"model": "gemini-2.5-flash", "prompt": prompt, "response_schema": categorization_schema(allowed_names)}
+
+    if stream:
+        def chunks():
+            for chunk in model.generate_content(prompt, generation_config=generation_config, stream=True):
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks without text parts (e.g. the final finish-reason chunk)
+                    continue
+                if text:
+                    yield text
+        return cassette.stream('gemini-categorize', recorded_request, chunks)
 
-    # If a log file is provided by main_process.py, use it.
-    if log_file:
-        log_file.write("\n" + "="*20 + " LOGGING GEMINI API REQUEST " + "="*20 + "\n")
-        log_file.write(prompt + "\n")
-        log_file.write("="*24 + " END OF API REQUEST LOG " + "="*24 + "\n\n")
-        log_file.flush()
-    # Otherwise (when run manually), save the payload to a dedicated file.
-    else:
-        with open('api_request_payload_gemini.txt', 'w', encoding='utf-8') as f:
-            f.write(prompt)
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        return cassette.call('gemini-categorize', recorded_request,
+                             lambda: model.generate_content(prompt, generation_config=generation_config).text)
     except Exception as e:
-        # REVISED: On any error, log it and terminate the entire script
-        error_message = f"!!! FATAL Gemini API Error: {e}\nTerminating script."
-        print(f"    ! {error_message}")
-        if log_file:
-            log_file.write(error_message + '\n')
-        sys.exit(1)
+        _fatal_categorization_error('Gemini', e, log_file)
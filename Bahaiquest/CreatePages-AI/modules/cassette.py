@@ -0,0 +1,185 @@
+# modules/cassette.py
+r"""
+Record/replay layer for network traffic (library search and AI provider calls).
+
+In record mode every request/response pair is appended to a gzip-compressed JSON Lines
+cassette. In replay mode the same requests are answered from the cassette, without any
+network access, API keys, or rate-limit delays, so the later stages (formatting,
+validation, parsers) can be rerun and profiled offline in seconds.
+
+Requests are matched by a hash of their content (URL + payload, or model + prompts);
+authorization headers are never part of the key and never stored. If a request was
+recorded more than once, replay serves the most recent response. A request missing from
+the cassette raises CassetteMiss rather than silently going to the network.
+
+Configuration (in .env or the environment):
+  CASSETTE_MODE   off (default), record, or replay
+  CASSETTE_PATH   Cassette file. Default: workspace/cassettes/<name>.jsonl.gz, where
+                  <name> is the keyword when run through main_process.py, else "default"
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import threading
+import requests
+
+try:
+    from . import profiling
+except ImportError:
+    import profiling
+
+MODES = ('off', 'record', 'replay')
+
+_name = 'default'
+_cassettes = {}
+_lock = threading.Lock()
+_END = object()
+
+class CassetteMiss(KeyError):
+    """Raised in replay mode for a request that was never recorded."""
+
+def mode():
+    value = os.getenv("CASSETTE_MODE", "off").lower()
+    if value not in MODES:
+        raise ValueError(f"CASSETTE_MODE must be one of {', '.join(MODES)}, not '{value}'.")
+    return value
+
+def replaying():
+    return mode() == 'replay'
+
+def use(name):
+    """Selects the cassette for the current run (main_process.py uses the keyword)."""
+    global _name
+    _name = name
+
+def cassette_path():
+    if os.getenv("CASSETTE_PATH"):
+        return os.getenv("CASSETTE_PATH")
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(project_root, 'workspace', 'cassettes', f'{_name}.jsonl.gz')
+
+def make_key(kind, request):
+    canonical = json.dumps({"kind": kind, "request": request}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class Cassette:
+    def __init__(self, path):
+        self.path = path
+        self.responses = None
+
+    def _load(self):
+        self.responses = {}
+        if not os.path.exists(self.path):
+            return
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.responses[entry["key"]] = entry["response"]
+
+    def play(self, key, kind):
+        if self.responses is None:
+            self._load()
+        if key not in self.responses:
+            raise CassetteMiss(f"No recorded {kind} response in {self.path} for this request. "
+                               f"Record it first with CASSETTE_MODE=record.")
+        return self.responses[key]
+
+    def record(self, key, kind, request, response):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        line = json.dumps({"key": key, "kind": kind, "request": request, "response": response}, ensure_ascii=False)
+        # Appending creates a new gzip member per entry, which gzip.open reads back as one stream
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            f.write(line + '\n')
+        if self.responses is not None:
+            self.responses[key] = response
+
+def _cassette():
+    path = cassette_path()
+    if path not in _cassettes:
+        _cassettes[path] = Cassette(path)
+    return _cassettes[path]
+
+def _live(function):
+    with profiling.network_wait():
+        return function()
+
+def _timed_chunks(live_chunks):
+    """Yields from live_chunks(), counting only the waits for the next chunk as network time."""
+    chunks = iter(_live(live_chunks))
+    while True:
+        with profiling.network_wait():
+            chunk = next(chunks, _END)
+        if chunk is _END:
+            return
+        yield chunk
+
+def call(kind, request, live_function):
+    """
+    Returns live_function() (a JSON-serializable response) according to CASSETTE_MODE.
+    `request` must contain everything that determines the response, and no secrets.
+    """
+    current_mode = mode()
+    if current_mode == 'off':
+        return _live(live_function)
+    key = make_key(kind, request)
+    if current_mode == 'replay':
+        with _lock:
+            return _cassette().play(key, kind)
+    response = _live(live_function)
+    with _lock:
+        _cassette().record(key, kind, request, response)
+    return response
+
+def stream(kind, request, live_chunks):
+    """
+    Streaming counterpart of call(): yields text chunks from the iterator `live_chunks()`.
+    A stream is recorded only once it has finished, so a broken stream is never replayed.
+    """
+    current_mode = mode()
+    if current_mode == 'off':
+        yield from _timed_chunks(live_chunks)
+        return
+    key = make_key(kind, request)
+    if current_mode == 'replay':
+        with _lock:
+            chunks = _cassette().play(key, kind)
+        yield from chunks
+        return
+    chunks = []
+    for chunk in _timed_chunks(live_chunks):
+        chunks.append(chunk)
+        yield chunk
+    with _lock:
+        _cassette().record(key, kind, request, chunks)
+
+class RecordedResponse:
+    """The parts of a requests.Response that the search code reads."""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+def post(url, headers=None, json=None):
+    """
+    Drop-in for requests.post(url, headers=..., json=...). Only successful (200) responses
+    are recorded, so replay never re-enacts rate-limit backoff.
+    """
+    request = {"url": url, "payload": json}
+    current_mode = mode()
+    if current_mode == 'off':
+        return _live(lambda: requests.post(url, headers=headers, json=json))
+    if current_mode == 'replay':
+        with _lock:
+            return RecordedResponse(200, _cassette().play(make_key('http', request), 'http'))
+
+    response = _live(lambda: requests.post(url, headers=headers, json=json))
+    if response.status_code == 200:
+        with _lock:
+            _cassette().record(make_key('http', request), 'http', request, response.text)
+    return response
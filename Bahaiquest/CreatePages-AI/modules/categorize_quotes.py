@@ -1,11 +1,19 @@
 # modules/categorize_quotes.py (UPDATED)
 import os
+import re
+import sys
 import json
 import string
 try:
-    from . import ai_processors
+    from . import ai_processors, cassette, dedup_quotes, jsonl_io, paragraph_store, profiling, records
 except ImportError:
     import ai_processors
+    import cassette
+    import dedup_quotes
+    import jsonl_io
+    import paragraph_store
+    import profiling
+    import records
 
 BASE62_CHARS = string.digits + string.ascii_letters # 0-9, a-z, A-Z
 
@@ -22,33 +30,159 @@ def to_base_62(n, pad_to_length):
 
     return encoded.zfill(pad_to_length) # Pad with leading zeros if needed
 
-def parse_custom_format(raw_text, id_to_location_map, id_length):
-    """Parses the model's custom text output back into a category map."""
-    category_map = {}
-    lines = raw_text.strip().split('\n')
-
-    for line in lines:
-        if ':' not in line:
-            continue # Skip malformed lines
-
-        category_name, ids_string = line.split(':', 1)
-        category_name = category_name.strip()
-        ids_string = ids_string.strip()
+_DECODER = json.JSONDecoder()
+_CATEGORIES_ARRAY = re.compile(r'"categories"\s*:\s*\[')
+
+class CategoryStreamParser:
+    """
+    Incremental, validating parser for the structured categorization response
+    {"categories": [{"name": ..., "ids": [...]}, ...]}.
+
+    feed() buffers text chunks and returns the (category_name, locations) pairs for every
+    category object completed so far. An unfinished object is kept until more text arrives,
+    so a broken stream never yields a half-received list of IDs. close() parses whatever is
+    left once the stream has ended normally.
+
+    Parsing is only attempted when a chunk could have completed something (an opening
+    bracket before the array, a closing one inside it), so a large category object is not
+    re-decoded for every chunk of it that arrives.
+
+    IDs are checked against the ID map instead of being trusted: unknown IDs and IDs
+    already assigned to an earlier category are collected in `unknown_ids` and
+    `duplicate_ids` and not applied. unassigned() lists the IDs the model left out.
+    """
+
+    def __init__(self, id_to_location_map):
+        self.id_to_location_map = id_to_location_map
+        self.buffer = ''
+        self.pending = []  # Chunks received since the last parse attempt
+        self.in_array = False
+        self.finished = False
+        self.assigned_ids = set()
+        self.unknown_ids = []
+        self.duplicate_ids = []
+
+    def feed(self, chunk):
+        self.pending.append(chunk)
+        if ('}' in chunk or ']' in chunk) if self.in_array else '[' in chunk:
+            return self._parse_available()
+        return []
+
+    def close(self):
+        return self._parse_available()
+
+    def unassigned(self):
+        return [seq_id for seq_id in self.id_to_location_map if seq_id not in self.assigned_ids]
+
+    def _parse_available(self):
+        parsed = []
+        if self.pending:
+            self.buffer += ''.join(self.pending)
+            self.pending = []
+        if not self.in_array:
+            match = _CATEGORIES_ARRAY.search(self.buffer)
+            if not match:
+                return parsed
+            self.buffer = self.buffer[match.end():]
+            self.in_array = True
+
+        while not self.finished:
+            position = 0
+            while position < len(self.buffer) and self.buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(self.buffer):
+                break
+            if self.buffer[position] == ']':
+                self.finished = True
+                break
+            try:
+                category, end = _DECODER.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                break # Incomplete object; wait for more text
+            self.buffer = self.buffer[end:]
+            result = self._validate(category)
+            if result:
+                parsed.append(result)
+        return parsed
+
+    def _validate(self, category):
+        if not isinstance(category, dict) or not isinstance(category.get('ids'), list):
+            return None
+        category_name = str(category.get('name') or '').strip() or 'Uncategorized'
 
         locations = []
-        for i in range(0, len(ids_string), id_length):
-            seq_id = ids_string[i:i + id_length]
-            original_location = id_to_location_map.get(seq_id)
-            if original_location:
-                locations.append(original_location)
-
-        if locations:
-            category_map[category_name] = locations
+        for seq_id in category['ids']:
+            seq_id = str(seq_id).strip()
+            if seq_id not in self.id_to_location_map:
+                self.unknown_ids.append(seq_id)
+            elif seq_id in self.assigned_ids:
+                self.duplicate_ids.append(seq_id)
+            else:
+                self.assigned_ids.add(seq_id)
+                locations.append(self.id_to_location_map[seq_id])
+
+        if not locations:
+            return None
+        return category_name, locations
+
+# --- Checkpointing ---
+# Assignments are keyed by location (stable across runs), not by the sequential IDs,
+# which are regenerated for whatever is still unassigned.
+
+def _checkpoint_path(output_dir, model_name):
+    return os.path.join(output_dir, f'categorization_checkpoint-{model_name}.json')
+
+def load_checkpoint(output_dir, model_name):
+    """Returns {location: category} saved by an interrupted run, or an empty dict."""
+    path = _checkpoint_path(output_dir, model_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_checkpoint(output_dir, model_name, location_to_category):
+    """Atomically writes the current assignments so a crash never leaves a torn file."""
+    path = _checkpoint_path(output_dir, model_name)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(location_to_category, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_previous_categories(output_dir, keyword, model_name):
+    """Returns {location: (hash, category)} from the categorized files of an earlier run."""
+    previous = {}
+    for filename in os.listdir(output_dir):
+        if filename.startswith(keyword) and filename.endswith(f'_categorized-{model_name}.txt'):
+            for quote in records.iter_quotes(os.path.join(output_dir, filename)):
+                if quote.hash:
+                    previous[quote.location] = (quote.hash, quote.title)
+    return previous
+
+def assign_ids(refs, store, use_fragments=False):
+    """
+    Maps locations to compact, fixed-length base-62 IDs for the prompt (short IDs keep the
+    response, which lists every ID, small).
+    `refs` is a list of (location, hash, fragments) tuples; the text is read from the
+    paragraph store only here, so the prompt payload is the single in-memory copy of the
+    paragraphs. With use_fragments, a paragraph that has highlight fragments is sent as
+    those fragments only (see search_library.py), which costs far fewer tokens.
+    """
+    id_to_location_map = {}
+    quotes_for_ai = []
+    # Calculate the fixed length needed for all IDs (e.g., for 1592 quotes, this will be 2)
+    id_length = len(to_base_62(max(len(refs) - 1, 0), 1))
 
-    return category_map
+    for i, (location, digest, fragments) in enumerate(refs):
+        sequential_id = to_base_62(i, id_length)
+        id_to_location_map[sequential_id] = location
+        quotes_for_ai.append({
+            "id": sequential_id,
+            "quote": ' ... '.join(fragments) if use_fragments and fragments else store.get_text(digest)
+        })
+    return id_to_location_map, quotes_for_ai
 
 # The run function now accepts an optional log_file argument
-def run(input_dir, output_dir, keyword, model_name, log_file=None):
+def run(input_dir, output_dir, keyword, model_name, log_file=None, max_requests=3, context=None, refresh=False):
 
     # --- NEW: Helper function for logging ---
     def log(message):
@@ -58,7 +192,9 @@ def run(input_dir, output_dir, keyword, model_name, log_file=None):
             log_file.write(message + '\n')
             log_file.flush()
 
-    log(f"\n----- Running Categorization (on full text) with {model_name} -----")
+    # 'full' sends whole paragraphs; 'fragments' sends the search highlight fragments where present
+    context = context or os.getenv("CATEGORIZE_CONTEXT", "full")
+    log(f"\n----- Running Categorization (on {'highlight fragments' if context == 'fragments' else 'full text'}) with {model_name} -----")
 
     if model_name.lower() == 'chatgpt':
         categorize_function = ai_processors.categorize_with_chatgpt
@@ -67,91 +203,154 @@ def run(input_dir, output_dir, keyword, model_name, log_file=None):
     else:
         raise ValueError("Unsupported model. Choose 'chatgpt' or 'gemini'.")
 
-    # 1. Aggregate all full quotes from original source files
-    all_quotes_with_locations = []
-    original_files_data = {}
-    files_to_process = [f for f in os.listdir(input_dir) if f.startswith(keyword) and f.endswith('.txt') and '_distilled' not in f and '_organized' not in f and '_categorized' not in f and '_final' not in f]
+    # 1. Collect a (location, hash, fragments) reference for every paragraph. The text stays in
+    #    the paragraph store until the prompt is built.
+    all_refs = []
+    files_to_process = jsonl_io.source_files(input_dir, keyword)
 
-    log("Aggregating all full paragraphs for categorization...")
+    store = paragraph_store.ParagraphStore()
+
+    # Near-duplicates of another paragraph (see dedup_quotes.py) are not sent; they
+    # inherit their representative's category below.
+    member_to_representative = dedup_quotes.load_member_map(input_dir)
+
+    log("Collecting all paragraphs for categorization...")
     for filename in files_to_process:
         filepath = os.path.join(input_dir, filename)
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            original_files_data[filename] = data
-            for item in data:
-                all_quotes_with_locations.append({
-                    "location": item['location'],
-                    "quote": item['quote']
-                })
-
-    if not all_quotes_with_locations:
+        for ref in store.iter_refs(filepath):
+            if ref.location not in member_to_representative:
+                all_refs.append((ref.location, ref.hash, ref.fragments))
+    store.commit()
+    if member_to_representative:
+        log(f"Skipping {len(member_to_representative)} duplicate paragraphs (categorized via their representative).")
+
+    if not all_refs:
         log("No quotes found to categorize. Exiting.")
+        store.close()
         return
 
-    log("Mapping original locations to compact sequential IDs...")
-    id_to_location_map = {}
-    quotes_for_ai = []
-
-    total_quotes = len(all_quotes_with_locations)
-    # Calculate the fixed length needed for all IDs (e.g., for 1592 quotes, this will be 2)
-    id_length = len(to_base_62(total_quotes - 1, 1))
-
-    for i, item in enumerate(all_quotes_with_locations):
-        sequential_id = to_base_62(i, id_length)
-        original_location = item['location']
-
-        id_to_location_map[sequential_id] = original_location
-        quotes_for_ai.append({
-            "id": sequential_id,
-            "quote": item['quote']
-        })
-    log(f"Generated {total_quotes} sequential IDs of fixed length {id_length}.")
-
-    # 2. Get the raw text mapping from the AI
-    raw_text_response = categorize_function(quotes_for_ai, keyword, log_file=log_file)
+    # 2. Resume from a checkpoint left by an interrupted stream, if any
+    location_to_category = load_checkpoint(output_dir, model_name)
+    if location_to_category:
+        log(f"Resuming from checkpoint: {len(location_to_category)} paragraphs already categorized.")
+
+    # In a refresh, paragraphs whose location and content are unchanged keep their category.
+    # Only new or changed ones are requested, with the existing categories (see refresh.py).
+    previous_categories = set()
+    if refresh:
+        previous = load_previous_categories(output_dir, keyword, model_name)
+        previous_categories = {category for _, category in previous.values()}
+        kept = 0
+        for location, digest, _ in all_refs:
+            if location not in location_to_category and location in previous and previous[location][0] == digest:
+                location_to_category[location] = previous[location][1]
+                kept += 1
+        log(f"Refresh: kept the categories of {kept} unchanged paragraphs; "
+            f"{len(all_refs) - len(location_to_category)} new or changed paragraphs to categorize.")
+
+    def consume(parsed_lines):
+        for category, locations in parsed_lines:
+            for location in locations:
+                location_to_category.setdefault(location, category)
+        if parsed_lines:
+            save_checkpoint(output_dir, model_name, location_to_category)
+
+    # The category set is only final once a response has completed (or, in a refresh, from the
+    # earlier run). Until then, the categories seen so far are suggestions, not a restriction.
+    categories_final = bool(previous_categories)
 
     raw_output_path = os.path.join(output_dir, f'api_request_return_{model_name.lower()}.txt')
-    log(f"Saving raw model output to {raw_output_path}...")
-    with open(raw_output_path, 'w', encoding='utf-8') as f:
-        f.write(raw_text_response)
-
-    # 3. Parse the custom format back into a standard dictionary
-    log("Parsing custom text format back into a category map...")
-    category_map = parse_custom_format(raw_text_response, id_to_location_map, id_length)
-
-    # 4. Create a reverse map for easy lookup: {location -> category_name}
-    location_to_category = {
-        location: category
-        for category, locations in category_map.items()
-        for location in locations
-    }
-
-    # 4. Write new categorized files, preserving the full quote
-    log("Writing categorized output files (with full quotes)...")
-    for original_filename, items_list in original_files_data.items():
+    log(f"Streaming raw model output to {raw_output_path}...")
+
+    # 3. Stream the categorization, consuming each completed category object as it arrives.
+    #    Whatever is still unassigned afterwards (the stream broke, or the model left IDs
+    #    out or assigned them twice) is re-requested on its own, together with the
+    #    categories established so far, instead of rerunning the whole categorization.
+    with open(raw_output_path, 'w', encoding='utf-8') as raw_file:
+        for attempt in range(1, max_requests + 1):
+            pending = [ref for ref in all_refs if ref[0] not in location_to_category]
+            if not pending:
+                break
+
+            established = sorted((set(location_to_category.values()) | previous_categories) - {'Uncategorized'})
+            if established:
+                log(f"Requesting {len(pending)} remaining paragraphs with the {len(established)} "
+                    f"{'established categories' if categories_final else 'categories seen so far as suggestions'} "
+                    f"(request {attempt}/{max_requests}).")
+                raw_file.write(f"\n[follow-up request for {len(pending)} paragraphs]\n")
+
+            log("Mapping original locations to compact sequential IDs...")
+            id_to_location_map, quotes_for_ai = assign_ids(pending, store, use_fragments=context == 'fragments')
+            log(f"Generated {len(pending)} sequential IDs.")
+
+            parser = CategoryStreamParser(id_to_location_map)
+
+            try:
+                for chunk in categorize_function(quotes_for_ai, keyword, log_file=log_file, stream=True,
+                                                 categories=established or None,
+                                                 allow_new_categories=not categories_final):
+                    raw_file.write(chunk)
+                    raw_file.flush()
+                    consume(parser.feed(chunk))
+                consume(parser.close())
+            except cassette.CassetteMiss:
+                raise
+            except Exception as e:
+                remaining = len(all_refs) - len(location_to_category)
+                log(f"  ! Stream interrupted (request {attempt}/{max_requests}): {e}")
+                log(f"  ! {remaining} paragraphs still unassigned; progress saved to checkpoint.")
+                raw_file.write(f"\n[stream interrupted: {e}]\n")
+                if attempt == max_requests:
+                    log("!!! FATAL: Categorization stream failed repeatedly. Rerun to resume from the checkpoint.")
+                    sys.exit(1)
+                continue
+
+            if parser.unknown_ids:
+                log(f"  ! Ignored {len(parser.unknown_ids)} unknown IDs: {', '.join(parser.unknown_ids[:20])}")
+            if parser.duplicate_ids:
+                log(f"  ! {len(parser.duplicate_ids)} IDs were assigned to more than one category; kept the first: "
+                    f"{', '.join(parser.duplicate_ids[:20])}")
+            if parser.finished:
+                categories_final = True
+            else:
+                log("  ! The response ended before the categories list was complete.")
+            missing = parser.unassigned()
+            if missing:
+                log(f"  ! The model left {len(missing)} paragraphs unassigned.")
+
+        leftover = len(all_refs) - len(location_to_category)
+        if leftover:
+            log(f"  ! {leftover} paragraphs are still unassigned after {max_requests} requests; marking them Uncategorized.")
+
+    # 4. Write new categorized files, referencing the full quote in the paragraph store
+    log("Writing categorized output files (as paragraph store references)...")
+    for original_filename in files_to_process:
         base_name = os.path.splitext(original_filename)[0]
         output_filename = f"{base_name}_categorized-{model_name}.txt"
         output_path = os.path.join(output_dir, output_filename)
 
-        categorized_data = []
-        for item in items_list:
-            category = location_to_category.get(item['location'], 'Uncategorized')
-            new_item = item.copy()
-            new_item['title'] = category
-            categorized_data.append(new_item)
-
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(categorized_data, f, indent=2, ensure_ascii=False)
+        with jsonl_io.JsonlWriter(output_path) as writer:
+            for ref in store.iter_refs(os.path.join(input_dir, original_filename)):
+                representative = member_to_representative.get(ref.location, ref.location)
+                ref.title = records.intern_name(location_to_category.get(representative, 'Uncategorized'))
+                writer.write(ref)
 
         log(f"  -> Saved categorized output to {output_path}")
 
+    store.close()
+
+    # The run completed, so the checkpoint must not leak into a future run
+    checkpoint_path = _checkpoint_path(output_dir, model_name)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
 if __name__ == '__main__':
-    import sys
     from dotenv import load_dotenv
 
+    profile = profiling.pop_flag()
     # Check for valid number of arguments (keyword, and optional model)
     if len(sys.argv) not in [2, 3]:
-        print("Usage: python modules/categorize_quotes.py <keyword> [model_name]")
+        print("Usage: python modules/categorize_quotes.py <keyword> [model_name] [--profile]")
         print("  [model_name] is optional (ChatGPT or Gemini). If omitted, both are run.")
         print("\nExample (run both):")
         print("  python modules/categorize_quotes.py government")
@@ -162,6 +361,9 @@ if __name__ == '__main__':
     load_dotenv()
 
     keyword = sys.argv[1]
+    cassette.use(keyword)
+    if profile:
+        profiling.profile_script(keyword, 'categorize')
 
     # Determine which models to process
     models_to_process = []
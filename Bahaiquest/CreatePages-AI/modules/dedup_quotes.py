@@ -0,0 +1,190 @@
+# modules/dedup_quotes.py
+r"""
+Collapses duplicate and near-duplicate paragraphs before the LLM stages.
+
+Compilations (e.g. Gleanings, Additional Tablets) repeat passages from the source tablets,
+often with small differences in punctuation or an omitted sentence. This stage groups such
+paragraphs into clusters so that only one representative per cluster is categorized and
+distilled; the results are then fanned out to every member's location.
+
+  1. Exact duplicates: identical text after normalization (case, punctuation, whitespace).
+  2. Near duplicates: MinHash signatures over word shingles, bucketed with LSH banding,
+     then confirmed by the true Jaccard similarity of the shingle sets.
+
+The clusters are written to <keyword_dir>/dedup_clusters.json as
+{"clusters": {representative_location: [member_location, ...]}} (members exclude the
+representative; singletons are omitted).
+
+Usage: python dedup_quotes.py <keyword> [threshold] [--profile]
+"""
+
+import os
+import re
+import json
+import struct
+import hashlib
+from collections import defaultdict
+
+try:
+    from . import jsonl_io, paragraph_store, profiling
+except ImportError:
+    import jsonl_io
+    import paragraph_store
+    import profiling
+
+CLUSTERS_FILENAME = 'dedup_clusters.json'
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16            # 16 bands x 4 rows: a pair collides with probability 1-(1-J^4)^16, only ~64% at J=0.5, ~99% at J=0.7
+DEFAULT_THRESHOLD = 0.7
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+def _permutations(num_permutations, seed=42):
+    """Deterministic (a, b) coefficients for the universal hash functions."""
+    coefficients = []
+    for i in range(num_permutations):
+        digest = hashlib.sha256(f"{seed}:{i}".encode('utf-8')).digest()
+        a, b = struct.unpack('<QQ', digest[:16])
+        coefficients.append((a % (_MERSENNE_PRIME - 1) + 1, b % _MERSENNE_PRIME))
+    return coefficients
+
+_PERMUTATIONS = _permutations(NUM_PERMUTATIONS)
+
+def normalize(text):
+    """Lowercases, strips punctuation and collapses whitespace."""
+    return ' '.join(re.sub(r"[^\w\s]", ' ', text.lower()).split())
+
+def shingles(normalized_text, size=SHINGLE_SIZE):
+    words = normalized_text.split()
+    if len(words) <= size:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def minhash(shingle_set):
+    """MinHash signature (one minimum per permutation) of a set of shingles."""
+    hashes = [struct.unpack('<I', hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest())[0]
+              for s in shingle_set]
+    return tuple(
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    )
+
+def jaccard(set_a, set_b):
+    if not set_a and not set_b:
+        return 1.0
+    return len(set_a & set_b) / len(set_a | set_b)
+
+def find_clusters(paragraphs, threshold=DEFAULT_THRESHOLD):
+    """
+    `paragraphs` is an ordered list of (location, text). Returns
+    {representative_location: [member_locations]} for clusters with more than one paragraph.
+    The first paragraph of each cluster (in input order) is its representative.
+    """
+    parent = list(range(len(paragraphs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            # Keep the earliest paragraph as the root, so it becomes the representative
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    # 1. Exact duplicates after normalization
+    normalized = [normalize(text) for _, text in paragraphs]
+    first_by_text = {}
+    for i, text in enumerate(normalized):
+        if text in first_by_text:
+            union(first_by_text[text], i)
+        else:
+            first_by_text[text] = i
+
+    # 2. Near duplicates via MinHash + LSH, only for the first copy of each exact group
+    shingle_sets = {}
+    buckets = defaultdict(list)
+    rows = NUM_PERMUTATIONS // LSH_BANDS
+    for i in first_by_text.values():
+        shingle_sets[i] = shingles(normalized[i])
+        signature = minhash(shingle_sets[i])
+        for band in range(LSH_BANDS):
+            buckets[(band, signature[band * rows:(band + 1) * rows])].append(i)
+
+    checked = set()
+    for candidates in buckets.values():
+        for x in range(len(candidates)):
+            for y in range(x + 1, len(candidates)):
+                pair = (candidates[x], candidates[y])
+                if pair in checked:
+                    continue
+                checked.add(pair)
+                if jaccard(shingle_sets[pair[0]], shingle_sets[pair[1]]) >= threshold:
+                    union(*pair)
+
+    clusters = defaultdict(list)
+    for i in range(len(paragraphs)):
+        root = find(i)
+        if root != i:
+            clusters[paragraphs[root][0]].append(paragraphs[i][0])
+    return dict(clusters)
+
+def load_member_map(keyword_dir):
+    """Returns {member_location: representative_location}, or {} if dedup has not been run."""
+    path = os.path.join(keyword_dir, CLUSTERS_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        clusters = json.load(f)["clusters"]
+    return {member: representative for representative, members in clusters.items() for member in members}
+
+def run(input_dir, keyword, threshold=DEFAULT_THRESHOLD):
+    print(f"\n----- Collapsing duplicate paragraphs (Jaccard >= {threshold}) -----")
+
+    files_to_process = jsonl_io.source_files(input_dir, keyword)
+
+    paragraphs = []
+    seen_locations = set()
+    with paragraph_store.ParagraphStore() as store:
+        for filename in files_to_process:
+            for ref in store.iter_refs(os.path.join(input_dir, filename)):
+                if ref.location in seen_locations:
+                    continue
+                seen_locations.add(ref.location)
+                paragraphs.append((ref.location, store.get_text(ref.hash)))
+
+    clusters = find_clusters(paragraphs, threshold)
+    collapsed = sum(len(members) for members in clusters.values())
+
+    output_path = os.path.join(input_dir, CLUSTERS_FILENAME)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump({"threshold": threshold, "clusters": clusters}, f, indent=2, ensure_ascii=False)
+
+    print(f"  -> {len(paragraphs)} paragraphs, {len(clusters)} duplicate clusters; "
+          f"{collapsed} paragraphs will reuse their representative's results.")
+    print(f"  -> Saved clusters to {output_path}")
+    return clusters
+
+if __name__ == '__main__':
+    import sys
+
+    profile = profiling.pop_flag()
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python modules/dedup_quotes.py <keyword> [threshold] [--profile]")
+        sys.exit(1)
+
+    keyword = sys.argv[1]
+    threshold = float(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_THRESHOLD
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    project_root = os.path.dirname(script_dir)
+    keyword_dir = os.path.join(project_root, 'workspace', keyword)
+
+    if profile:
+        profiling.profile_script(keyword, 'dedup')
+    run(keyword_dir, keyword, threshold)
@@ -1,22 +1,181 @@
 # modules/distill_quotes.py (UPDATED)
 import os
-import json
 import re
+import json
+import time
+import difflib
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from . import ai_processors
+    from . import ai_processors, cassette, dedup_quotes, jsonl_io, model_router, paragraph_store, profiling, records, validate_quotes
 except ImportError:
     import ai_processors
+    import cassette
+    import dedup_quotes
+    import jsonl_io
+    import model_router
+    import paragraph_store
+    import profiling
+    import records
+    import validate_quotes
+
+DISTILL_MODEL_NAMES = {'chatgpt': 'ChatGPT', 'gemini': 'Gemini', 'auto': 'Auto'}
+
+def configured_model():
+    """The distillation model of the main pipeline: DISTILL_MODEL (ChatGPT, Gemini or Auto; default ChatGPT)."""
+    value = os.getenv("DISTILL_MODEL", "ChatGPT")
+    if value.lower() not in DISTILL_MODEL_NAMES:
+        raise ValueError(f"DISTILL_MODEL must be ChatGPT, Gemini or Auto, not '{value}'.")
+    return DISTILL_MODEL_NAMES[value.lower()]
+
+def get_distill_function(model_name):
+    """Returns a callable(paragraph, keyword) for the requested model.
+
+    'Auto' uses the model router, which picks a model per paragraph and falls back
+    along a chain when a provider is throttled (see model_router.py).
+    """
+    if model_name.lower() == 'chatgpt':
+        return ai_processors.distill_with_chatgpt
+    elif model_name.lower() == 'gemini':
+        return ai_processors.distill_with_gemini
+    elif model_name.lower() == 'auto':
+        return model_router.ModelRouter().distill
+    else:
+        raise ValueError("Unsupported model. Choose 'chatgpt', 'gemini' or 'auto'.")
+
+def verbatim_fragments(ref, text):
+    """The quote's highlight fragments that occur word for word in its paragraph."""
+    fragments = [fragment.strip() for fragment in (ref.fragments or [])]
+    return [fragment for fragment in fragments if fragment and fragment in text]
+
+def fragment_excerpt(fragments, keyword):
+    """Non-LLM excerpt: the first fragment mentioning the keyword, else the first fragment."""
+    for fragment in fragments:
+        if keyword.lower() in fragment.lower():
+            return fragment
+    return fragments[0]
+
+# --- Excerpt cache ---
+# Excerpts are cached in the paragraph store under "<keyword>:<model ID>:<prompt hash>",
+# so a changed prompt or default model never serves an excerpt the current setup did not
+# produce. Excerpts distilled from highlight fragments only get a ":window" suffix.
+
+DISTILL_MODEL_IDS = {'chatgpt': ai_processors.CHATGPT_DISTILL_MODEL, 'gemini': ai_processors.GEMINI_DISTILL_MODEL}
+
+def distill_work_key(keyword, model_id, context='full'):
+    key = f"{keyword}:{model_id}:{ai_processors.distillation_prompt_hash()}"
+    return key if context == 'full' else f"{key}:{context}"
+
+def cache_enabled():
+    """DISTILL_CACHE=off ignores cached excerpts; the new ones still replace them in the cache."""
+    return os.getenv("DISTILL_CACHE", "on").lower() != 'off'
+
+def clear_cache(keyword):
+    """Deletes every cached excerpt of a keyword (all models, prompts and contexts)."""
+    with paragraph_store.ParagraphStore() as store:
+        deleted = store.clear_work('distill', f"{keyword}:")
+    print(f"Deleted {deleted} cached excerpts for keyword '{keyword}'.")
+    return deleted
+
+def _router(distill_function):
+    router = getattr(distill_function, '__self__', None)
+    return router if isinstance(router, model_router.ModelRouter) else None
+
+def cached_model_ids(model_name, distill_function, text):
+    """
+    Models whose cached excerpt of `text` may be reused, in order of preference. 'Auto'
+    accepts any model of the router's chain for the paragraph's size.
+    """
+    router = _router(distill_function)
+    if router is not None:
+        return router.base_chain(text)
+    return [DISTILL_MODEL_IDS[model_name.lower()]]
+
+def producing_model_id(model_name, distill_function):
+    """The model that produced the excerpt distill_function just returned."""
+    router = _router(distill_function)
+    return router.last_model if router is not None else DISTILL_MODEL_IDS[model_name.lower()]
+
+def distill_file(input_path, output_path, keyword, model_name, distill_function, store, member_to_representative=None,
+                 context=None):
+    """
+    Distills every quote of one categorized file. Excerpts are cached in the paragraph
+    store per (paragraph, keyword, model ID, prompt), so a paragraph shared by several
+    source files or reruns is only sent to the model once (unless DISTILL_CACHE=off).
+
+    `context` (default: DISTILL_CONTEXT from the environment) chooses what a quote with
+    search highlight fragments is distilled from: 'full' sends the whole paragraph, 'window'
+    sends only the fragments, and 'fragment' uses a fragment as the excerpt with no model
+    call at all. Quotes without fragments always use the full paragraph.
+
+    Near-duplicates (member_to_representative, from dedup_quotes.py) that do need a
+    full-paragraph excerpt reuse their representative's when it occurs verbatim in their
+    own text, and are only distilled separately when it does not.
+    """
+    member_to_representative = member_to_representative or {}
+    context = context or os.getenv("DISTILL_CONTEXT", "full")
+    use_cache = cache_enabled()
+    stats = {"reused": 0, "fanned_out": 0, "from_fragments": 0}
+
+    def excerpt_for(digest, text=None, count_reuse=True, window=False):
+        # Excerpts of a fragment window are cached apart from full-paragraph ones
+        key_context = 'window' if window else 'full'
+        text = text if text is not None else store.get_text(digest)
+        if use_cache:
+            for model_id in cached_model_ids(model_name, distill_function, text):
+                excerpt = store.get_work(digest, 'distill', distill_work_key(keyword, model_id, key_context))
+                if excerpt is not None:
+                    if count_reuse:
+                        stats["reused"] += 1
+                    return excerpt
+        excerpt = distill_function(text, keyword)
+        if not excerpt.startswith('[['):
+            work_key = distill_work_key(keyword, producing_model_id(model_name, distill_function), key_context)
+            store.put_work(digest, 'distill', work_key, excerpt)
+            store.commit()
+        return excerpt
+
+    # Records are read and written one at a time, so memory does not grow with the file
+    with jsonl_io.JsonlWriter(output_path) as writer:
+        for ref in store.iter_refs(input_path):
+            distilled_quote_text = None
+
+            # The context choice comes first, so a duplicate with usable fragments is never
+            # given (or made to pay for) its representative's full-paragraph excerpt
+            if context != 'full' and ref.fragments:
+                fragments = verbatim_fragments(ref, store.get_text(ref.hash))
+                if fragments and context == 'fragment':
+                    distilled_quote_text = fragment_excerpt(fragments, keyword)
+                    stats["from_fragments"] += 1
+                elif fragments and context == 'window':
+                    distilled_quote_text = excerpt_for(ref.hash, ' ... '.join(fragments), window=True)
+
+            representative = member_to_representative.get(ref.location)
+            if distilled_quote_text is None and representative is not None:
+                representative_text = store.text_for_location(representative)
+                if representative_text is not None:
+                    candidate = excerpt_for(paragraph_store.content_hash(representative_text), representative_text,
+                                            count_reuse=False)
+                    if not candidate.startswith('[[') and candidate.strip('. ') in store.get_text(ref.hash):
+                        distilled_quote_text = candidate
+                        stats["fanned_out"] += 1
+
+            if distilled_quote_text is None:
+                distilled_quote_text = excerpt_for(ref.hash)
+
+            writer.write(records.Quote(ref.title, ref.location, quote=distilled_quote_text))
+
+    if stats["reused"]:
+        print(f"  -> Reused {stats['reused']} cached excerpts from the paragraph store.")
+    if stats["fanned_out"]:
+        print(f"  -> {stats['fanned_out']} duplicate paragraphs took their representative's excerpt.")
+    if stats["from_fragments"]:
+        print(f"  -> {stats['from_fragments']} excerpts taken directly from search highlight fragments (no model call).")
 
 def run(input_dir, output_dir, keyword, model_name, source_model_name=None):
     print(f"\n----- Running Distillation (on categorized text) with {model_name} -----")
 
-    if model_name.lower() == 'chatgpt':
-        distill_function = ai_processors.distill_with_chatgpt
-    elif model_name.lower() == 'gemini':
-        distill_function = ai_processors.distill_with_gemini
-    else:
-        raise ValueError("Unsupported model. Choose 'chatgpt' or 'gemini'.")
+    distill_function = get_distill_function(model_name)
 
     # This logic correctly finds files based on the source_model_name passed to it
     source_suffix = source_model_name or model_name
@@ -26,32 +185,203 @@ def run(input_dir, output_dir, keyword, model_name, source_model_name=None):
         print(f"No files found ending in '_categorized-{source_suffix}.txt'. Skipping.")
         return
 
+    member_to_representative = dedup_quotes.load_member_map(input_dir)
+
     for filename in files_to_process:
         input_path = os.path.join(input_dir, filename)
 
-        base_name = re.sub(r'_categorized-(ChatGPT|Gemini)\.txt$', '', filename)
+        base_name = re.sub(r'_categorized-(ChatGPT|Gemini|Auto)\.txt$', '', filename)
         output_filename = f"{base_name}_final_for_wiki-{model_name}.txt"
         output_path = os.path.join(output_dir, output_filename)
 
         print(f"Processing {filename}...")
 
-        with open(input_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with paragraph_store.ParagraphStore() as store:
+            distill_file(input_path, output_path, keyword, model_name, distill_function, store,
+                         member_to_representative)
 
-        final_data = []
-        for item in data:
-            distilled_quote_text = distill_function(item['quote'], keyword)
-            final_item = {
-                "title": item['title'],
-                "location": item['location'],
-                "quote": distilled_quote_text
-            }
-            final_data.append(final_item)
+        print(f"  -> Saved final distilled & categorized output to {output_path}")
 
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(final_data, f, indent=2, ensure_ascii=False)
+    router = _router(distill_function)
+    if router is not None:
+        print(router.summary())
+    print(ai_processors.cache_stats_summary())
+
+# --- Comparison mode ---
+# Distills every paragraph with several providers at once and reports how they agree.
+
+COMPARISON_REPORT_FILENAME = 'distill_comparison_report.json'
+
+def _words(excerpt):
+    return re.findall(r"\w+", excerpt.lower())
+
+def _agreement(excerpt_a, excerpt_b):
+    """(exact_match, overlap_ratio) of two excerpts, compared word by word."""
+    words_a, words_b = _words(excerpt_a), _words(excerpt_b)
+    return words_a == words_b, difflib.SequenceMatcher(None, words_a, words_b, autojunk=False).ratio()
+
+def _timed_call(distill_function, text, keyword):
+    start = time.monotonic()
+    excerpt = distill_function(text, keyword)
+    return excerpt, time.monotonic() - start
+
+def distill_concurrently(texts, keyword, models, store, workers):
+    """
+    Returns {(model, hash): (excerpt, seconds)} for every paragraph in `texts` ({hash: text})
+    and every model. Each paragraph is sent to all models at the same time; excerpts already
+    cached in the paragraph store are reused (with seconds=None) instead of being requested.
+
+    Only the worker threads talk to the providers. The paragraph store (an SQLite connection,
+    which must stay on its own thread) is read and written on the calling thread alone.
+    """
+    functions = {model: get_distill_function(model) for model in models}
+    work_keys = {model: distill_work_key(keyword, DISTILL_MODEL_IDS[model.lower()]) for model in models}
+    use_cache = cache_enabled()
+    results = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for digest, text in texts.items():
+            for model in models:
+                cached = store.get_work(digest, 'distill', work_keys[model]) if use_cache else None
+                if cached is not None:
+                    results[(model, digest)] = (cached, None)
+                else:
+                    futures[(model, digest)] = executor.submit(_timed_call, functions[model], text, keyword)
+
+        for (model, digest), future in futures.items():
+            excerpt, seconds = future.result()
+            results[(model, digest)] = (excerpt, seconds)
+            if not excerpt.startswith('[['):
+                store.put_work(digest, 'distill', work_keys[model], excerpt)
+        store.commit()
+    return results
+
+def compare(input_dir, output_dir, keyword, source_model_name='Gemini', models=('ChatGPT', 'Gemini'), workers=8):
+    """
+    Comparison mode: reads the categorized files once, sends each paragraph to both models
+    of the pair `models` concurrently, writes each model's usual final_for_wiki files, and writes an
+    agreement report (exact match, word overlap, verbatim validity, latency, cost) to
+    COMPARISON_REPORT_FILENAME.
+
+    Near-duplicate members (see dedup_quotes.py) take their representative's excerpt when it
+    occurs verbatim in their own text, as in a normal run.
+    """
+    models = list(models)
+    print(f"\n----- Comparing distillation models: {' vs. '.join(models)} ({workers} concurrent calls) -----")
+
+    files_to_process = sorted(f for f in os.listdir(input_dir) if f.endswith(f"_categorized-{source_model_name}.txt"))
+    if not files_to_process:
+        print(f"No files found ending in '_categorized-{source_model_name}.txt'. Skipping.")
+        return None
+
+    member_to_representative = dedup_quotes.load_member_map(input_dir)
+
+    with paragraph_store.ParagraphStore() as store:
+        # 1. Read every input file once
+        refs_by_file = {filename: list(store.iter_refs(os.path.join(input_dir, filename)))
+                        for filename in files_to_process}
+        texts = {}
+        representative_hash = {}
+        for refs in refs_by_file.values():
+            for ref in refs:
+                representative = member_to_representative.get(ref.location)
+                representative_text = store.text_for_location(representative) if representative else None
+                if representative_text is not None:
+                    digest = paragraph_store.content_hash(representative_text)
+                    representative_hash[ref.location] = digest
+                    texts[digest] = representative_text
+                else:
+                    texts[ref.hash] = store.get_text(ref.hash)
+        print(f"Read {sum(len(refs) for refs in refs_by_file.values())} paragraphs from {len(files_to_process)} files "
+              f"({len(texts)} to distill).")
+
+        # 2. All models, all paragraphs, concurrently
+        results = distill_concurrently(texts, keyword, models, store, workers)
+
+        # Members whose representative's excerpt is not in their own text need their own call
+        own_texts = {}
+        for refs in refs_by_file.values():
+            for ref in refs:
+                digest = representative_hash.get(ref.location)
+                if digest is None:
+                    continue
+                text = store.get_text(ref.hash)
+                for model in models:
+                    excerpt = results[(model, digest)][0]
+                    if excerpt.startswith('[[') or excerpt.strip('. ') not in text:
+                        own_texts[ref.hash] = text
+        if own_texts:
+            results.update(distill_concurrently(own_texts, keyword, models, store, workers))
+
+        def excerpt_for(model, ref):
+            digest = representative_hash.get(ref.location)
+            if digest is not None:
+                excerpt = results[(model, digest)][0]
+                if not excerpt.startswith('[[') and excerpt.strip('. ') in store.get_text(ref.hash):
+                    return excerpt
+            return results[(model, ref.hash)][0]
+
+        # 3. Write each model's outputs and score the agreement per paragraph
+        paragraphs = []
+        for filename, refs in refs_by_file.items():
+            base_name = re.sub(r'_categorized-(ChatGPT|Gemini|Auto)\.txt$', '', filename)
+            excerpts_by_model = {}
+            for model in models:
+                excerpts_by_model[model] = [excerpt_for(model, ref) for ref in refs]
+                output_path = os.path.join(output_dir, f"{base_name}_final_for_wiki-{model}.txt")
+                jsonl_io.write_records(output_path, (
+                    records.Quote(ref.title, ref.location, quote=excerpt)
+                    for ref, excerpt in zip(refs, excerpts_by_model[model])))
+                print(f"  -> Saved {model} output to {output_path}")
+
+            for i, ref in enumerate(refs):
+                original = store.get_text(ref.hash)
+                excerpts = {model: excerpts_by_model[model][i] for model in models}
+                exact, overlap = _agreement(excerpts[models[0]], excerpts[models[1]])
+                paragraphs.append({
+                    "file": filename,
+                    "location": ref.location,
+                    "exact_match": exact,
+                    "overlap": round(overlap, 3),
+                    "excerpts": excerpts,
+                    "verbatim": {model: validate_quotes.is_verbatim(excerpt, original) for model, excerpt in excerpts.items()},
+                })
+
+    # 4. Summary
+    total = len(paragraphs)
+    summary = {"paragraphs": total, "models": models,
+               "exact_match_rate": sum(p["exact_match"] for p in paragraphs) / total if total else 0.0,
+               "mean_overlap": sum(p["overlap"] for p in paragraphs) / total if total else 0.0,
+               "per_model": {}}
+    # Estimated cost of distilling these paragraphs with each model, cached or not
+    input_tokens = sum(model_router.PROMPT_OVERHEAD_TOKENS + model_router.estimate_tokens(text) for text in texts.values())
+    for model in models:
+        timed = [seconds for (m, _), (_, seconds) in results.items() if m == model and seconds is not None]
+        output_tokens = sum(model_router.estimate_tokens(excerpt) for (m, _), (excerpt, _) in results.items() if m == model)
+        model_id = DISTILL_MODEL_IDS.get(model.lower())
+        summary["per_model"][model] = {
+            "verbatim_rate": sum(p["verbatim"][model] for p in paragraphs) / total if total else 0.0,
+            "failures": sum(p["excerpts"][model].startswith('[[') for p in paragraphs),
+            "calls": len(timed),
+            "mean_latency_seconds": sum(timed) / len(timed) if timed else None,
+            "estimated_cost_usd": model_router.estimate_cost(model_id, input_tokens, output_tokens) if model_id else None,
+        }
 
-        print(f"  -> Saved final distilled & categorized output to {output_path}")
+    report_path = os.path.join(output_dir, COMPARISON_REPORT_FILENAME)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"keyword": keyword, "source_model": source_model_name, "summary": summary,
+                   "paragraphs": paragraphs}, f, indent=2, ensure_ascii=False)
+
+    print(f"\nAgreement over {total} paragraphs: {summary['exact_match_rate']:.0%} identical, "
+          f"mean word overlap {summary['mean_overlap']:.2f}")
+    for model, stats in summary["per_model"].items():
+        latency = f"{stats['mean_latency_seconds']:.1f}s" if stats['mean_latency_seconds'] is not None else "n/a"
+        cost = f"${stats['estimated_cost_usd']:.2f}" if stats['estimated_cost_usd'] is not None else "n/a"
+        print(f"  {model}: {stats['verbatim_rate']:.0%} verbatim, {stats['failures']} failed, "
+              f"{stats['calls']} calls, mean latency {latency}, est. cost {cost}")
+    print(f"-> Saved comparison report to {report_path}")
+    print(ai_processors.cache_stats_summary())
+    return summary
 
 def process_single_categorized_file(input_path, output_dir, keyword, model_name):
     """Processes a single categorized file to distill its quotes."""
@@ -61,35 +391,18 @@ def process_single_categorized_file(input_path, output_dir, keyword, model_name)
         print(f"Error: Input file not found at '{input_path}'")
         return
 
-    if model_name.lower() == 'chatgpt':
-        distill_function = ai_processors.distill_with_chatgpt
-    elif model_name.lower() == 'gemini':
-        distill_function = ai_processors.distill_with_gemini
-    else:
-        raise ValueError("Unsupported model. Choose 'chatgpt' or 'gemini'.")
+    distill_function = get_distill_function(model_name)
 
     filename = os.path.basename(input_path)
-    base_name = re.sub(r'_categorized-(ChatGPT|Gemini)\.txt$', '', filename)
+    base_name = re.sub(r'_categorized-(ChatGPT|Gemini|Auto)\.txt$', '', filename)
     output_filename = f"{base_name}_final_for_wiki-{model_name}.txt"
     output_path = os.path.join(output_dir, output_filename)
 
     print(f"Processing {filename}...")
 
-    with open(input_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-
-    final_data = []
-    for item in data:
-        distilled_quote_text = distill_function(item['quote'], keyword)
-        final_item = {
-            "title": item['title'],
-            "location": item['location'],
-            "quote": distilled_quote_text
-        }
-        final_data.append(final_item)
-
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(final_data, f, indent=2, ensure_ascii=False)
+    with paragraph_store.ParagraphStore() as store:
+        distill_file(input_path, output_path, keyword, model_name, distill_function, store,
+                     dedup_quotes.load_member_map(os.path.dirname(input_path)))
 
     print(f"  -> Saved final output to {output_path}")
 
@@ -98,6 +411,23 @@ if __name__ == '__main__':
     import os
     from dotenv import load_dotenv
 
+    profile = profiling.pop_flag()
+    if len(sys.argv) == 3 and sys.argv[2] == '--clear-cache':
+        clear_cache(sys.argv[1])
+        sys.exit(0)
+
+    if len(sys.argv) in [3, 4] and sys.argv[2] == '--compare':
+        # Comparison mode: both providers at once, plus an agreement report
+        load_dotenv()
+        keyword = sys.argv[1]
+        cassette.use(keyword)
+        if profile:
+            profiling.profile_script(keyword, 'distill-compare')
+        keyword_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'workspace', keyword)
+        source_model = {'chatgpt': 'ChatGPT', 'gemini': 'Gemini'}.get(sys.argv[3].lower(), sys.argv[3]) if len(sys.argv) == 4 else 'Gemini'
+        compare(keyword_dir, keyword_dir, keyword, source_model_name=source_model)
+        sys.exit(0)
+
     # Updated help text to be more accurate
     if len(sys.argv) not in [2, 3, 4]:
         print("Usage:")
@@ -107,11 +437,19 @@ if __name__ == '__main__':
         print("     python modules/distill_quotes.py <keyword> <distill_model_name>")
         print("  3. Single File Mode:")
         print("     python modules/distill_quotes.py <keyword> <distill_model_name> <filename>")
+        print("  4. Comparison Mode (ChatGPT and Gemini concurrently, with an agreement report):")
+        print("     python modules/distill_quotes.py <keyword> --compare [source_model_name]")
+        print("  5. Delete the keyword's cached excerpts (set DISTILL_CACHE=off to only bypass them):")
+        print("     python modules/distill_quotes.py <keyword> --clear-cache")
+        print("  Add --profile to any mode to write profiling reports to workspace/<keyword>/profile.")
         sys.exit(1)
 
     load_dotenv()
 
     keyword = sys.argv[1]
+    cassette.use(keyword)
+    if profile:
+        profiling.profile_script(keyword, 'distill')
     script_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.dirname(script_dir)
     keyword_dir = os.path.join(project_root, 'workspace', keyword)
@@ -120,8 +458,8 @@ if __name__ == '__main__':
         # Case 1: Single file mode (This logic is unchanged)
         model_name_arg = sys.argv[2]
         filename = sys.argv[3]
-        if model_name_arg.lower() not in ['chatgpt', 'gemini']:
-            print(f"Error: Invalid model name '{model_name_arg}'. Use 'ChatGPT' or 'Gemini'.")
+        if model_name_arg.lower() not in ['chatgpt', 'gemini', 'auto']:
+            print(f"Error: Invalid model name '{model_name_arg}'. Use 'ChatGPT', 'Gemini' or 'Auto'.")
             sys.exit(1)
 
         input_path = os.path.join(keyword_dir, filename)
@@ -141,8 +479,10 @@ if __name__ == '__main__':
                 models_to_process.append('ChatGPT')
             elif model_name_arg.lower() == 'gemini':
                 models_to_process.append('Gemini')
+            elif model_name_arg.lower() == 'auto':
+                models_to_process.append('Auto')
             else:
-                print(f"Error: Invalid model name '{model_name_arg}'. Use 'ChatGPT' or 'Gemini'.")
+                print(f"Error: Invalid model name '{model_name_arg}'. Use 'ChatGPT', 'Gemini' or 'Auto'.")
                 sys.exit(1)
         else: # No model specified, so run both
             models_to_process = ['ChatGPT', 'Gemini']
@@ -0,0 +1,145 @@
+# modules/excerpt_repair.py
+r"""
+Repairs excerpts that are almost, but not exactly, verbatim.
+
+Models often return an excerpt that differs from the source by a curly apostrophe, a
+dropped comma, or a missing diacritic. Instead of flagging those for a human (or another
+paid call), validate_quotes.py asks this module for the closest span of the original
+paragraph and, if it is close enough, puts the true verbatim text in the excerpt's place.
+
+  1. Both texts are normalized (Unicode compatibility forms, accents, case, punctuation and
+     whitespace), keeping a map from each normalized character to its original position.
+  2. Myers' bit-parallel algorithm finds where the excerpt ends in the paragraph with the
+     fewest edits (insertions, deletions, substitutions), in O(n) word operations; the same
+     search over the reversed texts finds where that span starts.
+  3. The span is mapped back to the original paragraph and widened to whole words. It
+     replaces the excerpt only if the edit distance is at most REPAIR_MAX_DISTANCE_RATIO
+     of the excerpt's normalized length.
+"""
+
+import os
+import unicodedata
+
+DEFAULT_MAX_DISTANCE_RATIO = 0.1
+MIN_REPAIR_LENGTH = 15      # Shorter excerpts are too ambiguous to repair safely
+
+def normalize_with_map(text):
+    """
+    Returns (normalized, positions): lowercase text without accents or punctuation and with
+    single spaces, plus the index in `text` of every normalized character.
+    """
+    chars = []
+    positions = []
+    previous_was_space = True
+    for index, original_char in enumerate(text):
+        for char in unicodedata.normalize('NFKD', original_char):
+            category = unicodedata.category(char)
+            if category == 'Mn' or category[0] in 'PS':
+                continue  # Accents, punctuation and symbols are ignored
+            if char.isspace():
+                if previous_was_space:
+                    continue
+                char = ' '
+                previous_was_space = True
+            else:
+                char = char.lower()
+                previous_was_space = False
+            chars.append(char)
+            positions.append(index)
+    if chars and chars[-1] == ' ':
+        chars.pop()
+        positions.pop()
+    return ''.join(chars), positions
+
+def best_match_end(pattern, text):
+    """
+    Myers (1999) bit-parallel approximate matching. Returns (distance, end): the smallest
+    edit distance between `pattern` and any substring of `text`, and the index of the last
+    character of the first such substring (-1 if the pattern is best matched by nothing).
+    """
+    m = len(pattern)
+    if m == 0:
+        return 0, -1
+
+    peq = {}
+    for i, char in enumerate(pattern):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    full = (1 << m) - 1
+    last_bit = 1 << (m - 1)
+    pv, mv = full, 0
+    score = m
+    best_score, best_end = m, -1
+
+    for j, char in enumerate(text):
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & full
+        mh = pv & xh
+        if ph & last_bit:
+            score += 1
+        elif mh & last_bit:
+            score -= 1
+        # No carry-in at the low end: a match may start anywhere in the text
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+        if score < best_score:
+            best_score, best_end = score, j
+    return best_score, best_end
+
+def find_closest_span(excerpt, original):
+    """
+    Returns (start, end, distance) of the span of `original` closest to `excerpt` (end is
+    exclusive, both in `original`'s indices), or None if nothing usable matched.
+    """
+    pattern, _ = normalize_with_map(excerpt)
+    normalized, positions = normalize_with_map(original)
+    distance, end = best_match_end(pattern, normalized)
+    if end < 0:
+        return None
+
+    # The start is where the reversed pattern best matches the reversed text ending at `end`
+    _, reversed_end = best_match_end(pattern[::-1], normalized[end::-1])
+    start = end - reversed_end
+    return positions[start], positions[end] + 1, distance
+
+def max_distance_ratio_setting():
+    # Read on every call, not at import: main_process.py loads .env after importing the modules
+    return float(os.getenv("REPAIR_MAX_DISTANCE_RATIO", str(DEFAULT_MAX_DISTANCE_RATIO)))
+
+def repair(excerpt, original, max_distance_ratio=None):
+    """
+    Returns (verbatim_span, distance) if `excerpt` is a near-verbatim copy of part of
+    `original`, else None. `excerpt` should already be stripped of surrounding ellipses.
+    max_distance_ratio defaults to REPAIR_MAX_DISTANCE_RATIO from the environment.
+    """
+    if max_distance_ratio is None:
+        max_distance_ratio = max_distance_ratio_setting()
+    pattern, _ = normalize_with_map(excerpt)
+    if len(pattern) < MIN_REPAIR_LENGTH:
+        return None
+
+    match = find_closest_span(excerpt, original)
+    if match is None:
+        return None
+    start, end, distance = match
+
+    # Never cut a word in half; the characters added count as edits
+    while start > 0 and original[start - 1].isalnum():
+        start -= 1
+        distance += 1
+    while end < len(original) and original[end].isalnum():
+        end += 1
+        distance += 1
+
+    if distance > int(len(pattern) * max_distance_ratio):
+        return None
+
+    # Keep the original's closing punctuation if the excerpt also ended on punctuation
+    if not excerpt[-1].isalnum():
+        while end < len(original) and unicodedata.category(original[end])[0] == 'P':
+            end += 1
+    return original[start:end], distance
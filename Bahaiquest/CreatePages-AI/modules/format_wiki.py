@@ -1,8 +1,13 @@
-import json
 import re
 import os
 from collections import defaultdict
 
+try:
+    from . import profiling, records
+except ImportError:
+    import profiling
+    import records
+
 # Define the mapping for file name components
 abbreviation_map = {
     "days-remembrance": "DR",
@@ -55,20 +60,17 @@ def run(input_dir, final_output_file, model_suffix):
     for filename in text_files:
         temp_key = filename.replace(f"{keyword}_", "")
         # Add re.IGNORECASE to make the match robust
-        abbreviation_key = re.sub(r'_final_for_wiki-(ChatGPT|Gemini)\.txt$', '', temp_key, flags=re.IGNORECASE)
+        abbreviation_key = re.sub(r'_final_for_wiki-(ChatGPT|Gemini|Auto)\.txt$', '', temp_key, flags=re.IGNORECASE)
 
         abbreviation = abbreviation_map.get(abbreviation_key, "")
         if not abbreviation:
             print(f"  ! Warning: No abbreviation found for '{abbreviation_key}' in {filename}")
 
         filepath = os.path.join(input_dir, filename)
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        for item in data:
-            category = item['title']
-            location = item['location']
-            quote = item['quote']
+        for item in records.iter_quotes(filepath):
+            category = item.title
+            location = item.location
+            quote = item.quote
 
             # Use abbreviation if found, otherwise fall back to the location
             reference = abbreviation if abbreviation else location
@@ -91,8 +93,11 @@ if __name__ == '__main__':
     import sys
     import os
 
+    profile = profiling.pop_flag()
     if len(sys.argv) not in [2, 3]:
-        # ... (help text is the same)
+        print("Usage: python modules/format_wiki.py <keyword> [model_name] [--profile]")
+        print("  Without a model name, formats the ChatGPT files into final_output_<keyword>.txt;")
+        print("  with one (ChatGPT, Gemini or Auto), into final_output_<model_name>_<keyword>.txt.")
         sys.exit(1)
 
     keyword = sys.argv[1]
@@ -105,8 +110,10 @@ if __name__ == '__main__':
             model_to_process = 'ChatGPT'
         elif model_arg.lower() == 'gemini':
             model_to_process = 'Gemini'
+        elif model_arg.lower() == 'auto':
+            model_to_process = 'Auto'
         else:
-            print(f"Error: Invalid model name '{sys.argv[2]}'. Use 'ChatGPT' or 'Gemini'.")
+            print(f"Error: Invalid model name '{sys.argv[2]}'. Use 'ChatGPT', 'Gemini' or 'Auto'.")
             sys.exit(1)
     else:
         # Default to ChatGPT for the main pipeline output
@@ -124,4 +131,6 @@ if __name__ == '__main__':
 
     model_suffix = f'_final_for_wiki-{model_to_process}.txt'
 
+    if profile:
+        profiling.profile_script(keyword, 'format')
     run(input_dir, final_output_file, model_suffix)
@@ -0,0 +1,85 @@
+# modules/jsonl_io.py
+r"""
+Streaming readers and writers for workspace files.
+
+Workspace files are written as JSON Lines (one record per line), so each stage can
+process records one at a time and peak memory does not grow with the number of
+paragraphs. Files written by older versions (a single indented JSON array) are still
+read transparently.
+"""
+
+import os
+import json
+
+# Markers in the names of the files the later stages derive from the search results
+DERIVED_FILE_MARKERS = ('_categorized', '_distilled', '_final', '_organized')
+
+def source_files(keyword_dir, keyword):
+    """The keyword's search result files in keyword_dir, sorted (excludes every derived file)."""
+    if not os.path.isdir(keyword_dir):
+        return []
+    return sorted(f for f in os.listdir(keyword_dir) if f.startswith(keyword) and f.endswith('.txt')
+                  and not any(marker in f for marker in DERIVED_FILE_MARKERS))
+
+def iter_records(path):
+    """Yields the records of a workspace file one at a time (JSONL or legacy JSON array)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        first_char = f.read(1)
+        while first_char and first_char.isspace():
+            first_char = f.read(1)
+        f.seek(0)
+
+        if first_char == '[':
+            # Legacy format: the whole array has to be parsed at once
+            yield from json.load(f)
+            return
+
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def count_records(path):
+    return sum(1 for _ in iter_records(path))
+
+class JsonlWriter:
+    """
+    Writes records one line at a time to a temporary file, which replaces `path` only
+    when the block exits without an error. Readers never see a half-written file.
+
+    With keep_empty=False, nothing is written if no records were added.
+    """
+
+    def __init__(self, path, keep_empty=True):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.keep_empty = keep_empty
+        self.count = 0
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.tmp_path, 'w', encoding='utf-8')
+        return self
+
+    def write(self, record):
+        # Quote records (see records.py) serialize themselves
+        line = record.to_json() if hasattr(record, 'to_json') else json.dumps(record, ensure_ascii=False)
+        self._file.write(line + '\n')
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None and (self.count or self.keep_empty):
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+def write_records(path, records):
+    """Writes an iterable of records as JSON Lines. Returns the number written."""
+    with JsonlWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
@@ -0,0 +1,163 @@
+# modules/model_router.py
+r"""
+Picks a distillation model per paragraph instead of sending everything to one model.
+
+Routing is based on three signals:
+  1. Paragraph size: short paragraphs go to the cheap/fast chain, long ones to the strong chain.
+  2. Observed health: a rolling average of latency and error rate per model, plus a
+     cooldown after a model is throttled (HTTP 429 / quota exhausted).
+  3. Budget: a cost ceiling per keyword. Once the estimated spend would cross it, only
+     models that still fit are tried.
+
+If the preferred model is throttled or failing, the next model in the chain is used.
+
+Configuration (all optional, in .env):
+  ROUTER_COST_CEILING_USD   Maximum estimated spend per keyword (default: no ceiling)
+  ROUTER_SHORT_TOKENS       Paragraphs at or below this many tokens use the short chain (default: 120)
+"""
+
+import os
+import time
+
+try:
+    from . import ai_processors, cassette
+except ImportError:
+    import ai_processors
+    import cassette
+
+# --- Model catalogue ---
+# Prices are USD per 1M tokens (input, output). Update them here when providers change pricing.
+MODEL_PROFILES = {
+    "gpt-4.1-mini":     {"provider": "chatgpt", "input_cost": 0.40,  "output_cost": 1.60},
+    "gpt-4-turbo":      {"provider": "chatgpt", "input_cost": 10.00, "output_cost": 30.00},
+    "gemini-2.5-flash": {"provider": "gemini",  "input_cost": 0.30,  "output_cost": 2.50},
+}
+
+# Fallback chains, tried in order. Short paragraphs rarely need the large model.
+SHORT_CHAIN = ["gpt-4.1-mini", "gemini-2.5-flash", "gpt-4-turbo"]
+LONG_CHAIN = ["gpt-4-turbo", "gemini-2.5-flash", "gpt-4.1-mini"]
+
+# Rough size of the static distillation instructions and of a typical excerpt, in tokens.
+PROMPT_OVERHEAD_TOKENS = 250
+EXPECTED_OUTPUT_TOKENS = 40
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English prose)."""
+    return max(1, len(text) // 4)
+
+def estimate_cost(model, input_tokens, output_tokens=EXPECTED_OUTPUT_TOKENS):
+    """Estimated USD cost of one call to `model`."""
+    profile = MODEL_PROFILES[model]
+    return (input_tokens * profile["input_cost"] + output_tokens * profile["output_cost"]) / 1_000_000
+
+class ModelStats:
+    """Rolling latency/error statistics for a single model."""
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.avg_latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.cooldown_until = 0.0
+
+    def record(self, latency, ok):
+        self.calls += 1
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency += self.smoothing * (latency - self.avg_latency)
+        self.error_rate += self.smoothing * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def throttle(self, seconds):
+        self.cooldown_until = time.monotonic() + seconds
+
+    def is_available(self):
+        return time.monotonic() >= self.cooldown_until
+
+class ModelRouter:
+    """Routes each distillation request to a model and falls back along a chain."""
+
+    def __init__(self, cost_ceiling=None, short_tokens=None, short_chain=None, long_chain=None,
+                 max_error_rate=0.5, slow_latency=30.0, throttle_cooldown=60.0):
+        if cost_ceiling is None and os.getenv("ROUTER_COST_CEILING_USD"):
+            cost_ceiling = float(os.getenv("ROUTER_COST_CEILING_USD"))
+        self.cost_ceiling = cost_ceiling
+        self.short_tokens = short_tokens or int(os.getenv("ROUTER_SHORT_TOKENS", "120"))
+        self.short_chain = short_chain or SHORT_CHAIN
+        self.long_chain = long_chain or LONG_CHAIN
+        self.max_error_rate = max_error_rate
+        self.slow_latency = slow_latency
+        self.throttle_cooldown = throttle_cooldown
+        self.stats = {model: ModelStats() for model in MODEL_PROFILES}
+        self.spent = 0.0
+        self.calls_per_model = {model: 0 for model in MODEL_PROFILES}
+        self.last_model = None  # The model that produced the most recent successful excerpt
+
+    def base_chain(self, paragraph):
+        """The chain for this paragraph's size, before health and budget are taken into account."""
+        return self.short_chain if estimate_tokens(paragraph) <= self.short_tokens else self.long_chain
+
+    def choose_chain(self, paragraph):
+        """Returns the ordered list of models to try for this paragraph."""
+        input_tokens = estimate_tokens(paragraph) + PROMPT_OVERHEAD_TOKENS
+
+        healthy, degraded = [], []
+        for model in self.base_chain(paragraph):
+            stats = self.stats[model]
+            if not stats.is_available():
+                continue
+            if self.cost_ceiling is not None and self.spent + estimate_cost(model, input_tokens) > self.cost_ceiling:
+                continue
+            unhealthy = stats.error_rate > self.max_error_rate or (
+                stats.avg_latency is not None and stats.avg_latency > self.slow_latency)
+            (degraded if unhealthy else healthy).append(model)
+
+        # Unhealthy models are still tried, just last.
+        return healthy + degraded
+
+    def distill(self, paragraph, keyword):
+        """Drop-in replacement for ai_processors.distill_with_* functions."""
+        chain = self.choose_chain(paragraph)
+        if not chain:
+            print("    ! Router: no model available within the cost ceiling or all are cooling down.")
+            return "[[Routed distillation failed]]"
+
+        system, prompt = ai_processors.distillation_prompts(keyword, paragraph)
+        input_tokens = estimate_tokens(system + prompt)
+
+        for model in chain:
+            provider = MODEL_PROFILES[model]["provider"]
+            call = ai_processors.call_chatgpt if provider == "chatgpt" else ai_processors.call_gemini
+            print(f"  > Distilling with {model} (routed)...")
+            start = time.monotonic()
+            try:
+                result = call(prompt, model=model, system=system)
+            except cassette.CassetteMiss:
+                # Not a model failure: falling back would only replay another unrecorded request
+                raise
+            except Exception as e:
+                self.stats[model].record(time.monotonic() - start, ok=False)
+                if ai_processors.is_throttle_error(e):
+                    print(f"    ! {model} is throttled, cooling down for {self.throttle_cooldown:.0f}s: {e}")
+                    self.stats[model].throttle(self.throttle_cooldown)
+                else:
+                    print(f"    ! {model} API error: {e}")
+                continue
+
+            self.stats[model].record(time.monotonic() - start, ok=True)
+            self.spent += estimate_cost(model, input_tokens, estimate_tokens(result))
+            self.calls_per_model[model] += 1
+            self.last_model = model
+            return result
+
+        return "[[Routed distillation failed]]"
+
+    def summary(self):
+        """One-line-per-model report of how requests were routed."""
+        lines = [f"Router summary (estimated spend: ${self.spent:.4f}"
+                 + (f" of ${self.cost_ceiling:.2f})" if self.cost_ceiling is not None else ")")]
+        for model, stats in self.stats.items():
+            latency = f"{stats.avg_latency:.2f}s" if stats.avg_latency is not None else "n/a"
+            lines.append(f"  {model}: {self.calls_per_model[model]} successful calls, "
+                         f"avg latency {latency}, error rate {stats.error_rate:.0%}")
+        return "\n".join(lines)
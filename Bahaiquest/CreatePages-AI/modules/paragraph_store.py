@@ -0,0 +1,127 @@
+# modules/paragraph_store.py
+r"""
+Global, content-addressed store for library paragraphs, shared by every keyword.
+
+The same paragraph is often matched by many keywords. Instead of keeping a full copy in
+each workspace file, the text is stored once in workspace/paragraph_store.sqlite under the
+SHA-256 of its content, and workspace files hold only references:
+
+    {"title": ..., "location": ..., "hash": ...}
+
+Paragraph-level results (e.g. a distilled excerpt for a given model and keyword) can be
+cached against the same hash with get_work()/put_work(), so later runs reuse them.
+
+Records are handled as records.Quote objects. Workspace files written before the store
+existed still contain a full "quote"; they are read transparently and converted to
+references the next time a stage rewrites them.
+"""
+
+import os
+import sqlite3
+import hashlib
+
+try:
+    from . import records
+except ImportError:
+    import records
+
+STORE_FILENAME = 'paragraph_store.sqlite'
+
+def default_store_path():
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(project_root, 'workspace', STORE_FILENAME)
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class ParagraphStore:
+    def __init__(self, path=None):
+        self.path = path or default_store_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS paragraphs (hash TEXT PRIMARY KEY, text TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS locations (location TEXT PRIMARY KEY, hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS work (
+                hash TEXT NOT NULL, stage TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                PRIMARY KEY (hash, stage, key)
+            );
+        """)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    # --- Paragraphs ---
+
+    def put(self, location, text):
+        """Stores a paragraph (once per unique content) and points `location` at it. Returns the hash."""
+        digest = content_hash(text)
+        self.conn.execute("INSERT OR IGNORE INTO paragraphs (hash, text) VALUES (?, ?)", (digest, text))
+        self.conn.execute("INSERT OR REPLACE INTO locations (location, hash) VALUES (?, ?)", (location, digest))
+        return digest
+
+    def get_text(self, digest):
+        row = self.conn.execute("SELECT text FROM paragraphs WHERE hash = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def text_for_location(self, location):
+        row = self.conn.execute(
+            "SELECT p.text FROM locations l JOIN paragraphs p ON p.hash = l.hash WHERE l.location = ?",
+            (location,)).fetchone()
+        return row[0] if row else None
+
+    # --- Paragraph-level work cache ---
+
+    def get_work(self, digest, stage, key):
+        row = self.conn.execute("SELECT value FROM work WHERE hash = ? AND stage = ? AND key = ?",
+                                (digest, stage, key)).fetchone()
+        return row[0] if row else None
+
+    def put_work(self, digest, stage, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO work (hash, stage, key, value) VALUES (?, ?, ?, ?)",
+                          (digest, stage, key, value))
+
+    def clear_work(self, stage, key_prefix=''):
+        """Deletes the cached results of `stage` whose key starts with `key_prefix`. Returns how many were deleted."""
+        cursor = self.conn.execute("DELETE FROM work WHERE stage = ? AND substr(key, 1, ?) = ?",
+                                   (stage, len(key_prefix), key_prefix))
+        self.conn.commit()
+        return cursor.rowcount
+
+    # --- Workspace records ---
+
+    def to_ref(self, quote):
+        """
+        Turns a Quote into a reference (no text), storing its text first if it has no hash yet.
+        A record without text (a search hit with no content_en) is stored as an empty paragraph.
+        """
+        if quote.hash is None:
+            quote.hash = self.put(quote.location, quote.quote or '')
+        quote.quote = None
+        return quote
+
+    def resolve(self, quote):
+        """Fills in the full paragraph text of a reference Quote."""
+        if quote.quote is None:
+            quote.quote = self.get_text(quote.hash)
+        return quote
+
+    def iter_items(self, path):
+        """Yields every record of a workspace file as a Quote with the paragraph text resolved."""
+        for quote in records.iter_quotes(path):
+            yield self.resolve(quote)
+
+    def iter_refs(self, path):
+        """Yields every record of a workspace file as a reference Quote, without loading paragraph text."""
+        for quote in records.iter_quotes(path):
+            yield self.to_ref(quote)
@@ -0,0 +1,167 @@
+# modules/planner.py
+r"""
+Dry-run planner: estimates API calls, tokens, cost and wall-clock time for a keyword
+before any paid call is made. Used by `python main_process.py <keyword> --plan`.
+
+Hit counts come from the first results page of each filter, fetched through the search
+response cache. That page is exactly the one the real search starts with, so a later
+run reuses it instead of fetching it again. The same page provides a sample of
+paragraphs for the token estimates.
+"""
+
+import time
+import random
+import importlib.util
+
+try:
+    from . import ai_processors, distill_quotes, model_router, response_cache, search_library
+except ImportError:
+    import ai_processors
+    import distill_quotes
+    import model_router
+    import response_cache
+    import search_library
+
+try:
+    # count_tokens.py lives in the project root, which is on the path when run from main_process.py
+    import count_tokens
+except ImportError:
+    count_tokens = None
+
+# --- Pipeline assumptions (match main_process.py) ---
+CATEGORIZATION_MODEL = "gemini-2.5-flash"
+
+SEARCH_PAGE_SIZE = 50
+SEARCH_PAGE_DELAY = 20.0       # average of the 10-30s pause after each result page fetched from the API
+SEARCH_FILTER_DELAY = 7.5      # average of the 5-10s pause after each source that went to the API
+
+# distill_quotes.py makes one call at a time, so distillation takes one call's latency per
+# paragraph. This is an estimate of that latency, not a setting of the pipeline.
+DISTILL_LATENCY_SECONDS = 3.0
+
+CATEGORIZATION_OUTPUT_TOKENS_PER_SECOND = 150.0
+JSON_OVERHEAD_TOKENS_PER_QUOTE = 12     # {"id": "..", "quote": ".."} framing in the prompt
+CATEGORIZATION_OUTPUT_TOKENS_PER_QUOTE = 3     # "id", entries in the JSON response
+
+def _count_tokens(text):
+    """Uses the count_tokens.py (tiktoken) counter when available, otherwise a character estimate."""
+    if count_tokens is not None and importlib.util.find_spec("tiktoken") is not None:
+        token_count = count_tokens.count_chatgpt_tokens(text)
+        if token_count is not None:
+            return token_count
+    return model_router.estimate_tokens(text)
+
+def _distillation_model(avg_paragraph_tokens):
+    """The model DISTILL_MODEL sends a paragraph of average size to (for Auto: the first of the router's chain)."""
+    model_name = distill_quotes.configured_model()
+    if model_name != 'Auto':
+        return distill_quotes.DISTILL_MODEL_IDS[model_name.lower()]
+    router = model_router.ModelRouter()
+    return (router.short_chain if avg_paragraph_tokens <= router.short_tokens else router.long_chain)[0]
+
+def _total_hits(body):
+    total = body.get("hits", {}).get("total", 0)
+    # Elasticsearch 7+ returns {"value": n, "relation": "eq"}; older versions a plain int
+    return total.get("value", 0) if isinstance(total, dict) else total
+
+def _format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f}m"
+    return f"{seconds / 3600:.1f}h"
+
+def sample_search(query, cache):
+    """
+    Returns (hits_per_filter, sample_paragraphs, uncached_pages, search_seconds).
+    uncached_pages is the number of pages the real search would still have to fetch from
+    the API; search_seconds the pauses search_library.py would make between them.
+    """
+    hits_per_filter = {}
+    samples = []
+    uncached_pages = 0
+    search_seconds = 0.0
+
+    for keyword_filter in search_library.load_keyword_filters():
+        body, fetched_from_network = search_library.fetch_search_page(
+            query, keyword_filter, 0, SEARCH_PAGE_SIZE, cache=cache,
+            fragment_size=search_library.HIGHLIGHT_FRAGMENT_SIZE)
+        if fetched_from_network:
+            time.sleep(random.uniform(5, 10))
+        if body is None:
+            continue
+
+        hits = _total_hits(body)
+        hits_per_filter[keyword_filter] = hits
+        samples.extend(hit["_source"].get("content_en") or "" for hit in body.get("hits", {}).get("hits", []))
+
+        # The search reads pages until one comes back empty, pausing after every result
+        # page it fetched from the API (not after the final empty one), and after the source
+        filter_misses = 0
+        for from_index in range(SEARCH_PAGE_SIZE, hits + SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE):
+            payload = search_library.build_search_payload(query, keyword_filter, from_index, SEARCH_PAGE_SIZE,
+                                                          search_library.HIGHLIGHT_FRAGMENT_SIZE)
+            if not cache.has(cache.make_key(search_library.url, payload)):
+                filter_misses += 1
+                if from_index < hits:
+                    search_seconds += SEARCH_PAGE_DELAY
+        if filter_misses:
+            uncached_pages += filter_misses
+            search_seconds += SEARCH_FILTER_DELAY
+
+    return hits_per_filter, samples, uncached_pages, search_seconds
+
+def plan(query, cache=None):
+    """Prints and returns per-stage estimates for running the full pipeline on `query`."""
+    cache = cache or response_cache.ResponseCache()
+    print(f"Sampling search results for '{query}' (served from the response cache when possible)...")
+    hits_per_filter, samples, uncached_pages, search_seconds = sample_search(query, cache)
+
+    total_paragraphs = sum(hits_per_filter.values())
+    avg_paragraph_tokens = (sum(_count_tokens(text) for text in samples) / len(samples)) if samples else 0
+    paragraph_tokens = total_paragraphs * avg_paragraph_tokens
+
+    # --- Categorization: one request with every paragraph ---
+    template_tokens = _count_tokens(ai_processors.CATEGORIZATION_PROMPT)
+    categorize_input = template_tokens + paragraph_tokens + total_paragraphs * JSON_OVERHEAD_TOKENS_PER_QUOTE
+    categorize_output = total_paragraphs * CATEGORIZATION_OUTPUT_TOKENS_PER_QUOTE + 200
+    categorize_seconds = categorize_output / CATEGORIZATION_OUTPUT_TOKENS_PER_SECOND + 10
+
+    # --- Distillation: one request per paragraph ---
+    system_tokens = _count_tokens(ai_processors.DISTILLATION_SYSTEM_PROMPT)
+    user_template_tokens = _count_tokens(ai_processors.DISTILLATION_USER_PROMPT)
+    distill_input = total_paragraphs * (system_tokens + user_template_tokens + avg_paragraph_tokens)
+    distill_output = total_paragraphs * model_router.EXPECTED_OUTPUT_TOKENS
+    distill_seconds = total_paragraphs * DISTILL_LATENCY_SECONDS
+    distillation_model = _distillation_model(avg_paragraph_tokens)
+
+    stages = [
+        {"stage": "search", "calls": uncached_pages, "input_tokens": 0, "output_tokens": 0,
+         "cost": 0.0, "seconds": search_seconds},
+        {"stage": f"categorize ({CATEGORIZATION_MODEL})", "calls": 1 if total_paragraphs else 0,
+         "input_tokens": categorize_input, "output_tokens": categorize_output,
+         "cost": model_router.estimate_cost(CATEGORIZATION_MODEL, categorize_input, categorize_output),
+         "seconds": categorize_seconds if total_paragraphs else 0},
+        {"stage": f"distill ({distillation_model})", "calls": total_paragraphs,
+         "input_tokens": distill_input, "output_tokens": distill_output,
+         "cost": model_router.estimate_cost(distillation_model, distill_input, distill_output),
+         "seconds": distill_seconds},
+    ]
+
+    print(f"\n========= PLAN FOR KEYWORD: '{query}' =========")
+    print(f"Paragraphs found: {total_paragraphs} across {len(hits_per_filter)} sources "
+          f"(avg {avg_paragraph_tokens:.0f} tokens per paragraph, sampled from {len(samples)})")
+    print(f"\n{'Stage':<32}{'API calls':>10}{'Input tok':>12}{'Output tok':>12}{'Cost':>10}{'Time':>9}")
+    for stage in stages:
+        print(f"{stage['stage']:<32}{stage['calls']:>10}{stage['input_tokens']:>12.0f}"
+              f"{stage['output_tokens']:>12.0f}{'$' + format(stage['cost'], '.2f'):>10}"
+              f"{_format_duration(stage['seconds']):>9}")
+    total_cost = sum(stage['cost'] for stage in stages)
+    total_seconds = sum(stage['seconds'] for stage in stages)
+    print(f"{'TOTAL':<32}{'':>10}{'':>12}{'':>12}{'$' + format(total_cost, '.2f'):>10}"
+          f"{_format_duration(total_seconds):>9}")
+    print(f"\nSearch time is the pipeline's pauses between uncached pages and sources. Distillation makes one "
+          f"call at a time; ~{DISTILL_LATENCY_SECONDS:.0f}s per call is assumed.")
+
+    return {"keyword": query, "paragraphs": total_paragraphs, "stages": stages,
+            "total_cost": total_cost, "total_seconds": total_seconds}
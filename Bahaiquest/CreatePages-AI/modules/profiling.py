@@ -0,0 +1,128 @@
+# modules/profiling.py
+r"""
+Optional per-stage profiling, enabled with --profile on main_process.py and on every
+module's command line.
+
+For each stage, these files are written to workspace/<keyword>/profile/ (runs that are not
+tied to one keyword, such as validate_quotes.py --all, use workspace/profile/):
+
+  <stage>.prof          cProfile data (load with pstats, or a viewer such as snakeviz)
+  <stage>-cpu.txt       the functions with the most cumulative time
+  <stage>-memory.txt    the source lines holding the most memory at the end of the stage (tracemalloc)
+  summary.json          per stage: wall-clock time, CPU time, network wait, other waiting
+                        (rate-limit pauses, disk) and peak traced memory
+
+Network wait is the time spent inside search requests and AI provider calls, which all go
+through cassette.py. Calls made on worker threads are summed, so it can exceed wall time.
+cProfile only sees the main thread. tracemalloc slows allocation-heavy code down, so
+compare the timings of profiled runs only with each other.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+_network_seconds = 0.0
+_network_lock = threading.Lock()
+
+@contextlib.contextmanager
+def network_wait():
+    """Counts the time spent in the enclosed block as network wait."""
+    global _network_seconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _network_lock:
+            _network_seconds += time.perf_counter() - start
+
+def pop_flag(argv=None):
+    """Removes --profile from the command line (sys.argv by default); returns whether it was there."""
+    argv = sys.argv if argv is None else argv
+    if '--profile' in argv:
+        argv.remove('--profile')
+        return True
+    return False
+
+def profile_dir(keyword=None):
+    """workspace/<keyword>/profile, or workspace/profile for a run across all keywords (keyword=None)."""
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if keyword is None:
+        return os.path.join(project_root, 'workspace', 'profile')
+    return os.path.join(project_root, 'workspace', keyword, 'profile')
+
+class Profiler:
+    def __init__(self, keyword, enabled=True):
+        self.enabled = enabled
+        self.directory = profile_dir(keyword)
+        self.stages = []
+        self._current = None
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        self._current = (name, profiler, time.perf_counter(), time.process_time(), _network_seconds)
+        profiler.enable()
+
+    def stop(self):
+        if self._current is None:
+            return
+        name, profiler, wall_start, cpu_start, network_start = self._current
+        profiler.disable()
+        self._current = None
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        network = _network_seconds - network_start
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(os.path.join(self.directory, f'{name}.prof'))
+        with open(os.path.join(self.directory, f'{name}-cpu.txt'), 'w', encoding='utf-8') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        with open(os.path.join(self.directory, f'{name}-memory.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"Peak traced memory: {peak / 1_000_000:.1f} MB\n\n")
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                f.write(f"{stat}\n")
+
+        self.stages.append({
+            "stage": name,
+            "wall_seconds": round(wall, 3),
+            "cpu_seconds": round(cpu, 3),
+            "network_wait_seconds": round(network, 3),
+            "other_wait_seconds": round(max(0.0, wall - cpu - network), 3),
+            "peak_memory_mb": round(peak / 1_000_000, 1),
+        })
+        # Rewritten after every stage, so a run that exits early still leaves a summary
+        with open(os.path.join(self.directory, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump({"stages": self.stages}, f, indent=2)
+        print(f"[profile] {name}: wall {wall:.1f}s, CPU {cpu:.1f}s, network wait {network:.1f}s, "
+              f"peak memory {peak / 1_000_000:.1f} MB -> {self.directory}")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+def profile_script(keyword, name):
+    """Profiles the rest of a module's command-line run as one stage, however it exits."""
+    profiler = Profiler(keyword)
+    profiler.start(name)
+    atexit.register(profiler.stop)
+    return profiler
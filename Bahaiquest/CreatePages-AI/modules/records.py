@@ -0,0 +1,77 @@
+# modules/records.py
+r"""
+Compact record type for paragraphs as they move between the pipeline stages.
+
+A Quote uses __slots__ instead of a per-instance dict, and interns its title and location:
+a keyword yields thousands of paragraphs but only a few dozen distinct titles (source
+names, later category names), so every record shares the same string objects. See
+bench_records.py in the project root for the memory difference on a large keyword.
+
+On disk a Quote is the same JSON object the workspace files always held, so files
+written before this type existed are read unchanged:
+
+    {"title": ..., "location": ..., "hash": ...}      paragraph store reference
+    {"title": ..., "location": ..., "quote": ...}     full text or distilled excerpt
+
+Either form may also carry "fragments": verbatim snippets around the keyword, returned by
+the search's highlighter (see search_library.py).
+"""
+
+import sys
+import json
+
+try:
+    from . import jsonl_io
+except ImportError:
+    import jsonl_io
+
+def intern_name(value):
+    """Interns a title, location or category name (anything else is returned unchanged)."""
+    return sys.intern(value) if type(value) is str else value
+
+class Quote:
+    __slots__ = ('title', 'location', 'hash', 'quote', 'fragments')
+
+    def __init__(self, title, location, hash=None, quote=None, fragments=None):
+        # Interned here only: code that later assigns a title (e.g. a category name) interns it itself
+        self.title = sys.intern(title) if type(title) is str else title
+        self.location = sys.intern(location) if type(location) is str else location
+        self.hash = hash
+        self.quote = quote
+        self.fragments = fragments
+
+    def __eq__(self, other):
+        if not isinstance(other, Quote):
+            return NotImplemented
+        return ((self.title, self.location, self.hash, self.quote, self.fragments)
+                == (other.title, other.location, other.hash, other.quote, other.fragments))
+
+    def __repr__(self):
+        return f"Quote(title={self.title!r}, location={self.location!r}, hash={self.hash!r})"
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record.get('title'), record.get('location'), record.get('hash'), record.get('quote'),
+                   record.get('fragments'))
+
+    @classmethod
+    def from_json(cls, line):
+        return cls.from_dict(json.loads(line))
+
+    def to_dict(self):
+        record = {"title": self.title, "location": self.location}
+        if self.hash is not None:
+            record["hash"] = self.hash
+        if self.quote is not None:
+            record["quote"] = self.quote
+        if self.fragments:
+            record["fragments"] = self.fragments
+        return record
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+def iter_quotes(path):
+    """Yields the records of a workspace file as Quote objects."""
+    for record in jsonl_io.iter_records(path):
+        yield Quote.from_dict(record)
@@ -0,0 +1,52 @@
+# modules/refresh.py
+r"""
+Delta refresh of a keyword workspace (`python main_process.py <keyword> --refresh`).
+
+When a keyword is regenerated later, most of its paragraphs are unchanged. The refresh
+compares the new search results with the previous ones by location and content hash:
+
+  - unchanged paragraphs keep their category (categorize_quotes.run with refresh=True)
+    and their excerpt (cached in the paragraph store, so distillation skips them);
+  - new or changed paragraphs are categorized against the existing category set in one
+    small request, and distilled;
+  - removed paragraphs simply drop out, since the later stages rebuild every file, and
+    final_output_<keyword>.txt, from the new search results.
+
+The diff is saved to <keyword_dir>/refresh_diff.json.
+"""
+
+import os
+import json
+
+try:
+    from . import jsonl_io, paragraph_store, records
+except ImportError:
+    import jsonl_io
+    import paragraph_store
+    import records
+
+DIFF_FILENAME = 'refresh_diff.json'
+
+def snapshot(keyword_dir, keyword):
+    """Returns {location: content_hash} for the keyword's current search results."""
+    location_to_hash = {}
+    for filename in jsonl_io.source_files(keyword_dir, keyword):
+        for quote in records.iter_quotes(os.path.join(keyword_dir, filename)):
+            # Workspaces from before the paragraph store hold the full text instead of a hash
+            location_to_hash[quote.location] = quote.hash or paragraph_store.content_hash(quote.quote or '')
+    return location_to_hash
+
+def diff(before, after):
+    """Compares two snapshots. Returns lists of new, changed and removed locations, and the unchanged count."""
+    return {
+        "new": sorted(location for location in after if location not in before),
+        "changed": sorted(location for location, digest in after.items() if location in before and before[location] != digest),
+        "removed": sorted(location for location in before if location not in after),
+        "unchanged": sum(1 for location, digest in after.items() if before.get(location) == digest),
+    }
+
+def write_diff(keyword_dir, result):
+    path = os.path.join(keyword_dir, DIFF_FILENAME)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    return path
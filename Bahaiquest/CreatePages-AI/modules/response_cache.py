@@ -0,0 +1,120 @@
+# modules/response_cache.py
+r"""
+Local on-disk cache for library search responses.
+
+Each response body is stored as a JSON file named after a hash of the full request
+(URL + payload), so any change to the query, filter, page offset or page size is a
+different entry. Entries expire after a TTL, and the oldest entries are evicted once
+the cache grows past a maximum size.
+
+Configuration (all optional, in .env):
+  SEARCH_CACHE_DIR          Cache directory (default: workspace/.search_cache)
+  SEARCH_CACHE_TTL_HOURS    Hours before an entry is considered stale (default: 168, one week)
+  SEARCH_CACHE_MAX_ENTRIES  Maximum number of cached responses (default: 5000)
+  SEARCH_CACHE_ONLY         "1" to never touch the network; misses return no results
+
+Several processes (e.g. queue_worker.py nodes sharing workspace/) may use the same cache
+directory, so any entry can disappear between two calls; that is treated as a miss.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+
+def _default_cache_dir():
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.path.join(project_root, 'workspace', '.search_cache')
+
+class ResponseCache:
+    def __init__(self, cache_dir=None, ttl_hours=None, max_entries=None, cache_only=None):
+        self.cache_dir = cache_dir or os.getenv("SEARCH_CACHE_DIR") or _default_cache_dir()
+        if ttl_hours is None:
+            ttl_hours = float(os.getenv("SEARCH_CACHE_TTL_HOURS", "168"))
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries or int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+        if cache_only is None:
+            cache_only = os.getenv("SEARCH_CACHE_ONLY", "0") == "1"
+        self.cache_only = cache_only
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(url, payload):
+        canonical = json.dumps({"url": url, "payload": payload}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def has(self, key):
+        """True if a fresh entry exists, without reading it or touching the hit counters."""
+        try:
+            age = time.time() - os.path.getmtime(self._path(key))
+        except FileNotFoundError:
+            return False
+        return age <= self.ttl_seconds or self.cache_only
+
+    def get(self, key):
+        """Returns the cached response body, or None if missing or expired."""
+        path = self._path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        if age > self.ttl_seconds and not self.cache_only:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Another process removed it first
+            self.misses += 1
+            return None
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            stored_at, body = entry["stored_at"], entry["body"]
+        except (OSError, json.JSONDecodeError, KeyError, TypeError):
+            # A torn, corrupt or malformed entry is just a miss
+            self.misses += 1
+            return None
+
+        # Reading an entry refreshes its access time, which eviction uses (LRU)
+        try:
+            os.utime(path, (time.time(), stored_at))
+        except FileNotFoundError:
+            pass  # Evicted by another process since it was read; the body is still valid
+        self.hits += 1
+        return body
+
+    def put(self, key, body):
+        path = self._path(key)
+        # A unique temporary name, so processes storing the same key do not replace each other's file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"stored_at": time.time(), "body": body}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries beyond max_entries."""
+        entries = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.json')]
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+        accessed = []
+        for path in entries:
+            try:
+                accessed.append((os.path.getatime(path), path))
+            except FileNotFoundError:
+                excess -= 1  # Already removed by another process
+        accessed.sort()
+        for _, path in accessed[:max(excess, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -3,17 +3,25 @@ This script uses the bahai.org/library api to search the Bahai writings by topic
 
 It is called as part of main_process.py but it can be run independently also:
 
-Usage: python search_library.py <keyword>
+Usage: python search_library.py <keyword> [--cache-only] [--fragments=<size>] [--profile]
 """
 
-import requests
-import json
 import sys
 import time
 import random
 import os
 from dotenv import load_dotenv
 
+try:
+    from . import cassette, jsonl_io, paragraph_store, profiling, records, response_cache
+except ImportError:
+    import cassette
+    import jsonl_io
+    import paragraph_store
+    import profiling
+    import records
+    import response_cache
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -21,84 +29,150 @@ load_dotenv()
 url = os.getenv("BAHAI_LIBRARY_API_URL")
 auth_token = os.getenv("BAHAI_LIBRARY_AUTH_TOKEN")
 
+# Characters per highlight fragment to request alongside each paragraph (0 = no fragments)
+HIGHLIGHT_FRAGMENT_SIZE = int(os.getenv("SEARCH_HIGHLIGHT_FRAGMENT_SIZE", "0"))
+HIGHLIGHT_FIELD = "content_en.en_norm_stem"
+HIGHLIGHT_FRAGMENT_COUNT = 3
+
 headers = {
     "Authorization": auth_token,
     "Content-Type": "application/json",
     "User-Agent": "Mozilla/5.0"
 }
 
+def build_search_payload(query, keyword_filter, from_index, batch_size, fragment_size=0):
+    """
+    The Elasticsearch request body for one page of results. With a fragment_size, the
+    highlighter also returns up to HIGHLIGHT_FRAGMENT_COUNT snippets around the matched
+    terms. The tags are empty, so each fragment is a verbatim piece of content_en.
+    """
+    payload = {
+        "query": {
+            "bool": {
+                "must": {
+                    "query_string": {
+                        "query": query,
+                        "fields": ["content_en.en_norm^10", "content_en.en_norm_stem"],
+                        "default_operator": "AND"
+                    }
+                },
+                "should": {
+                    "multi_match": {
+                        "query": query,
+                        "type": "phrase",
+                        "operator": "and",
+                        "fields": ["content_en.en_norm^100", "content_en.en_norm_stem^50"]
+                    }
+                },
+                "filter": {
+                    "term": {"unit": "para"}
+                }
+            }
+        },
+        "post_filter": {
+            "bool": {
+                "filter": [{"term": {"keywords": keyword_filter}}]
+            }
+        },
+        "sort": {"_score": "desc"},
+        "from": from_index,
+        "size": batch_size
+    }
+    if fragment_size:
+        payload["highlight"] = {
+            "pre_tags": [""],
+            "post_tags": [""],
+            "fields": {
+                HIGHLIGHT_FIELD: {"fragment_size": fragment_size, "number_of_fragments": HIGHLIGHT_FRAGMENT_COUNT}
+            }
+        }
+    return payload
+
+def fetch_search_page(query, keyword_filter, from_index, batch_size=50, max_retries=5, cache=None, fragment_size=0):
+    """
+    Fetches one page of raw search results. Returns (body, fetched_from_network);
+    body is None if the page could not be fetched (error, retries exhausted, or a
+    cache-only miss).
+    """
+    payload = build_search_payload(query, keyword_filter, from_index, batch_size, fragment_size)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(url, payload)
+        body = cache.get(cache_key)
+        if body is not None:
+            return body, False
+        if cache.cache_only:
+            print(f"  ! Cache-only mode: no cached page at offset {from_index} for filter '{keyword_filter}'.")
+            return None, False
+
+    retries = 0
+    while retries < max_retries:
+        response = cassette.post(url, headers=headers, json=payload)
+
+        if response.status_code == 200:
+            body = response.json()
+            if cache is not None:
+                cache.put(cache_key, body)
+            # Replayed pages come from disk, so they need no rate-limit pacing
+            return body, not cassette.replaying()
+
+        elif response.status_code == 429:
+            # Too many requests - exponential backoff
+            wait_time = (2 ** retries) + random.uniform(0, 1)
+            print(f"Rate limit hit. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+            retries += 1
+        else:
+            print(f"Error {response.status_code} for keyword '{keyword_filter}': {response.text}")
+            return None, True
+
+    # Retries exhausted
+    return None, True
+
 # Function to perform search with rate limiting
-def search_bahai_library(query, keyword_filter, batch_size=50, max_retries=5):
-    all_results = []
+def iter_search_pages(query, keyword_filter, batch_size=50, max_retries=5, cache=None, fragment_size=0):
+    """
+    Yields each page of results for a query/filter pair as soon as it is fetched, so
+    callers can write hits out page by page instead of holding them all in memory.
+
+    If a ResponseCache is given, pages are served from it when fresh (with no delay),
+    and newly fetched pages are stored in it. In cache-only mode a miss ends the search.
+    With a fragment_size, each Quote also carries the highlighter's fragments.
+
+    The generator's return value (StopIteration.value) is True if the search reached its
+    last page, and False if a page could not be fetched.
+    """
     from_index = 0
 
     while True:
-        payload = {
-            "query": {
-                "bool": {
-                    "must": {
-                        "query_string": {
-                            "query": query,
-                            "fields": ["content_en.en_norm^10", "content_en.en_norm_stem"],
-                            "default_operator": "AND"
-                        }
-                    },
-                    "should": {
-                        "multi_match": {
-                            "query": query,
-                            "type": "phrase",
-                            "operator": "and",
-                            "fields": ["content_en.en_norm^100", "content_en.en_norm_stem^50"]
-                        }
-                    },
-                    "filter": {
-                        "term": {"unit": "para"}
-                    }
-                }
-            },
-            "post_filter": {
-                "bool": {
-                    "filter": [{"term": {"keywords": keyword_filter}}]
-                }
-            },
-            "sort": {"_score": "desc"},
-            "from": from_index,
-            "size": batch_size
-        }
+        body, fetched_from_network = fetch_search_page(query, keyword_filter, from_index, batch_size, max_retries, cache,
+                                                       fragment_size)
+        if body is None:
+            return False
+
+        results = body.get("hits", {}).get("hits", [])
+        if not results:
+            return True  # No more results, stop fetching
 
-        retries = 0
-        while retries < max_retries:
-            response = requests.post(url, headers=headers, json=payload)
-
-            if response.status_code == 200:
-                results = response.json().get("hits", {}).get("hits", [])
-                if not results:
-                    return all_results  # No more results, stop fetching
-
-                for hit in results:
-                    source = hit["_source"]
-                    all_results.append({
-                        "title": source.get("title"),
-                        "location": source.get("location"),
-                        "quote": source.get("content_en")
-                    })
-
-                from_index += batch_size  # Move to the next batch
-
-                # Randomized delay (10 to 30 seconds) to prevent rate limiting
-                time.sleep(random.uniform(10, 30))
-                break
-
-            elif response.status_code == 429:
-                # Too many requests - exponential backoff
-                wait_time = (2 ** retries) + random.uniform(0, 1)
-                print(f"Rate limit hit. Retrying in {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-                retries += 1
-            else:
-                print(f"Error {response.status_code} for keyword '{keyword_filter}': {response.text}")
-                return all_results
+        yield [
+            records.Quote(hit["_source"].get("title"), hit["_source"].get("location"),
+                          quote=hit["_source"].get("content_en"),
+                          fragments=hit.get("highlight", {}).get(HIGHLIGHT_FIELD))
+            for hit in results
+        ]
 
+        from_index += batch_size  # Move to the next batch
+
+        if fetched_from_network:
+            # Randomized delay (10 to 30 seconds) to prevent rate limiting
+            time.sleep(random.uniform(10, 30))
+
+def search_bahai_library(query, keyword_filter, batch_size=50, max_retries=5, cache=None, fragment_size=0):
+    """Fetches every page of results for a query/filter pair and returns them as one list."""
+    all_results = []
+    for page in iter_search_pages(query, keyword_filter, batch_size, max_retries, cache, fragment_size):
+        all_results.extend(page)
     return all_results
 
 # Read keyword filters from file
@@ -117,13 +191,77 @@ def load_keyword_filters(filename="keyword_filter.txt"):
         print(f"Error: {file_path} not found.")
         sys.exit(1)
 
+def run(query, output_dir, cache_only=False, fragment_size=None, max_cache_age_hours=None):
+    """
+    Searches every keyword filter for `query` and writes one workspace file per filter.
+    fragment_size defaults to SEARCH_HIGHLIGHT_FRAGMENT_SIZE from the environment, and
+    max_cache_age_hours to the response cache's TTL (0 always fetches fresh results).
+    """
+    if fragment_size is None:
+        fragment_size = HIGHLIGHT_FRAGMENT_SIZE
+    os.makedirs(output_dir, exist_ok=True)
+    keyword_filters = load_keyword_filters()
+
+    cache = response_cache.ResponseCache(ttl_hours=max_cache_age_hours, cache_only=cache_only or None)
+
+    with paragraph_store.ParagraphStore() as store:
+        for keyword in keyword_filters:
+            print(f"Searching for query '{query}' with filter '{keyword}'...")
+            misses_before = cache.misses
+            filename = os.path.join(output_dir, f"{query}_{keyword}.txt")
+
+            # Hits are appended page by page; paragraph text goes to the shared store
+            # and the workspace file keeps only references
+            skipped = 0
+            pages = iter_search_pages(query, keyword, cache=cache, fragment_size=fragment_size)
+            with jsonl_io.JsonlWriter(filename, keep_empty=False) as writer:
+                while True:
+                    try:
+                        page = next(pages)
+                    except StopIteration as stop:
+                        complete = stop.value
+                        break
+                    for item in page:
+                        # A hit without paragraph text has nothing to categorize or excerpt
+                        if not item.quote:
+                            skipped += 1
+                            continue
+                        writer.write(store.to_ref(item))
+                    store.commit()
+
+            if writer.count:
+                print(f"  -> Saved {writer.count} results to {filename}")
+            elif complete and os.path.exists(filename):
+                # The source has no hits any more, so its old paragraphs must drop out. A failed
+                # fetch or cache-only miss (complete is False) keeps the previous file instead.
+                os.remove(filename)
+                print(f"  -> No results any more; removed {filename}")
+            if skipped:
+                print(f"  -> Skipped {skipped} hits without paragraph text.")
+
+            # Only pace ourselves if this filter actually went to the network
+            if cache.misses > misses_before and not cache.cache_only and not cassette.replaying():
+                time.sleep(random.uniform(5, 10))
+
+    print(f"Response cache: {cache.hits} hits, {cache.misses} misses.")
+
 # Command-line input handling
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python modules/search_library.py <query>")
+    # --cache-only serves every page from the local response cache and never hits the API
+    cache_only = '--cache-only' in sys.argv
+    profile = profiling.pop_flag()
+    # --fragments=<size> also stores highlight fragments of about <size> characters per hit
+    fragment_size = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('--fragments='):
+            fragment_size = int(arg.split('=', 1)[1])
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+    if len(args) < 1:
+        print("Usage: python modules/search_library.py <query> [--cache-only] [--fragments=<size>] [--profile]")
         sys.exit(1)
 
-    query = sys.argv[1]
+    query = args[0]
 
     # --- FIX: Construct path from project root, not script's directory ---
     # Get the directory of this script (e.g., /.../Bahaiquest/modules)
@@ -134,17 +272,7 @@ if __name__ == "__main__":
     output_dir = os.path.join(project_root, 'workspace', query)
     # --- END FIX ---
 
-    os.makedirs(output_dir, exist_ok=True)
-    keyword_filters = load_keyword_filters()
-
-    for keyword in keyword_filters:
-        print(f"Searching for query '{query}' with filter '{keyword}'...")
-        results = search_bahai_library(query, keyword)
-
-        if results:
-            filename = os.path.join(output_dir, f"{query}_{keyword}.txt")
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(results, f, indent=2, ensure_ascii=False)
-            print(f"  -> Saved {len(results)} results to {filename}")
-
-        time.sleep(random.uniform(5, 10))
+    cassette.use(query)
+    if profile:
+        profiling.profile_script(query, 'search')
+    run(query, output_dir, cache_only=cache_only, fragment_size=fragment_size)
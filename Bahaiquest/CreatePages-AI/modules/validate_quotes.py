@@ -3,16 +3,50 @@ import os
 import sys
 import re
 import json
+import mmap
+from concurrent.futures import ProcessPoolExecutor
 
-def load_original_quotes(keyword, keyword_dir):
+try:
+    from . import excerpt_repair, jsonl_io, paragraph_store, profiling
+except ImportError:
+    import excerpt_repair
+    import jsonl_io
+    import paragraph_store
+    import profiling
+
+INDEX_DATA_FILENAME = 'paragraph_index.dat'
+INDEX_OFFSETS_FILENAME = 'paragraph_index.json'
+REPORT_FILENAME = 'validation_report.json'
+
+class OriginalQuotes:
+    """
+    Lazy {location: full_quote_text} lookup. Only the location -> hash references are
+    held in memory; paragraph text is read from the paragraph store on demand.
+    """
+
+    def __init__(self, store, location_to_hash):
+        self.store = store
+        self.location_to_hash = location_to_hash
+
+    def get(self, location, default=None):
+        digest = self.location_to_hash.get(location)
+        if digest is None:
+            return default
+        return self.store.get_text(digest)
+
+    def __len__(self):
+        return len(self.location_to_hash)
+
+def load_original_quotes(keyword, keyword_dir, store=None):
     """
-    Loads all original, full-text quotes from the initial search results.
-    Returns a dictionary mapping {location_id: full_quote_text}.
+    Loads references to all original, full-text quotes from the initial search results.
+    Returns an OriginalQuotes lookup {location_id: full_quote_text}.
     """
-    originals = {}
+    store = store or paragraph_store.ParagraphStore()
+    location_to_hash = {}
     print("-> Loading original full-text quotes for comparison...")
     try:
-        source_files = [f for f in os.listdir(keyword_dir) if f.startswith(keyword) and f.endswith('.txt') and '_categorized' not in f and '_final' not in f]
+        source_files = jsonl_io.source_files(keyword_dir, keyword)
         if not source_files:
             print(f"  ! Warning: No original source files found in {keyword_dir}.")
             return None
@@ -22,13 +56,12 @@ def load_original_quotes(keyword, keyword_dir):
             if os.path.getsize(filepath) == 0:
                 print(f"  ! Warning: Skipping empty source file: {filename}")
                 continue
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                for item in data:
-                    originals[item['location']] = item['quote']
+            for ref in store.iter_refs(filepath):
+                location_to_hash[ref.location] = ref.hash
+        store.commit()
 
-        print(f"  -> Loaded {len(originals)} original quotes.")
-        return originals
+        print(f"  -> Loaded {len(location_to_hash)} original quotes.")
+        return OriginalQuotes(store, location_to_hash)
     except json.JSONDecodeError as e:
         print(f"  ! FATAL Error: A source file is not valid JSON. Please check files in '{keyword_dir}'. Error: {e}")
         return None
@@ -36,10 +69,20 @@ def load_original_quotes(keyword, keyword_dir):
         print(f"  ! Error loading original quotes: {e}")
         return None
 
+def is_verbatim(excerpt, original_quote):
+    """The strict check: the excerpt, without surrounding ellipses, occurs word for word in the original."""
+    return excerpt.strip().strip('...').strip() in original_quote
+
 def _validate_and_update_wikitext_file(final_file_path, original_quotes_map):
     """
-    Validates a single final WikiText output file. It parses {{q|...}} templates,
-    checks for verbatim excerpts, and adds a '[Warning]' tag in-place for any mismatches.
+    Validates a single final WikiText output file. It parses {{q|...}} templates and
+    checks for verbatim excerpts. An excerpt that is only a few edits away from a span of
+    the original (see excerpt_repair.py) is replaced in-place by that verbatim span; any
+    other mismatch gets a '[Warning]' tag.
+
+    `original_quotes_map` can be any object with a dict-style .get(location).
+    Returns (mismatches, repairs) for reporting: lists of {"location", "excerpt"} and
+    {"location", "excerpt", "repaired", "distance"}.
     """
     print(f"\n----- Validating: {os.path.basename(final_file_path)} -----")
 
@@ -48,10 +91,12 @@ def _validate_and_update_wikitext_file(final_file_path, original_quotes_map):
             lines = f.readlines()
     except Exception as e:
         print(f"!!! ERROR: Could not read final output file: {e}")
-        return
+        return [], []
 
     warnings_added = 0
     quotes_processed = 0
+    mismatches = []
+    repairs = []
     # Regex to capture the parts of the {{q|...}} template
     quote_template_regex = re.compile(r"(\{\{q\|)(.*?)(\|)(.*?)(\|)(.*?)(\}\})")
 
@@ -79,23 +124,37 @@ def _validate_and_update_wikitext_file(final_file_path, original_quotes_map):
                 continue
 
             # Perform the strict, verbatim check as requested
-            excerpt_for_check = excerpt.strip().strip('...').strip()
+            if is_verbatim(excerpt, original_quote):
+                continue
 
-            if excerpt_for_check not in original_quote:
+            excerpt_core = excerpt.strip().strip('...').strip()
+            repaired = excerpt_repair.repair(excerpt_core, original_quote) if excerpt_core else None
+            if repaired:
+                verbatim_span, distance = repaired
+                lines[i] = line.replace(excerpt, excerpt.replace(excerpt_core, verbatim_span, 1), 1)
+                repairs.append({"location": location, "excerpt": excerpt, "repaired": verbatim_span, "distance": distance})
+                print(f"  -> Repaired near-verbatim excerpt for location {location} ({distance} edits).")
+            else:
                 warnings_added += 1
                 # Reconstruct the line with the warning tag to preserve formatting
                 new_excerpt = f"[Warning] {excerpt}"
                 new_line = line.replace(excerpt, new_excerpt, 1) # Replace only the first occurrence
                 lines[i] = new_line
+                mismatches.append({"location": location, "excerpt": excerpt})
                 print(f"  -> Mismatch found for location {location}. Adding warning.")
 
+    if repairs:
+        print(f"-> Repaired {len(repairs)} near-verbatim excerpts.")
     if warnings_added > 0:
         print(f"-> Found {warnings_added} issues out of {quotes_processed} quotes.")
-        print(f"-> Overwriting file with warnings added.")
-        with open(final_file_path, 'w', encoding='utf-8') as f:
-            f.writelines(lines)
     else:
         print(f"-> Success! All {quotes_processed} quotes passed validation.")
+    if warnings_added > 0 or repairs:
+        print(f"-> Overwriting file with repairs and warnings applied.")
+        with open(final_file_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    return mismatches, repairs
 
 def validate(keyword):
     """
@@ -105,31 +164,159 @@ def validate(keyword):
     project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     keyword_dir = os.path.join(project_root, 'workspace', keyword)
 
-    original_quotes = load_original_quotes(keyword, keyword_dir)
-    if not original_quotes:
-        print("!!! Aborting validation: Could not load original quotes.")
-        sys.exit(1)
+    with paragraph_store.ParagraphStore() as store:
+        original_quotes = load_original_quotes(keyword, keyword_dir, store)
+        if not original_quotes:
+            print("!!! Aborting validation: Could not load original quotes.")
+            sys.exit(1)
+
+        print("\nSearching for final WikiText output files to validate...")
+        files_to_validate = []
+        file_pattern_end = f'_{keyword}.txt'
+        for filename in os.listdir(project_root):
+            if filename.startswith('final_output_') and filename.endswith(file_pattern_end):
+                 files_to_validate.append(os.path.join(project_root, filename))
+
+        if not files_to_validate:
+            print(f"\n!!! ERROR: No final output files found for keyword '{keyword}' in root directory.")
+            print("    Example expected filename: 'final_output_ChatGPT_power.txt'")
+            return
+
+        for file_path in files_to_validate:
+            if os.path.exists(file_path):
+                _validate_and_update_wikitext_file(file_path, original_quotes)
+
+# main_process.py calls the module's entry point run(), like the other stages.
+run = validate
+
+# --- Bulk validation across all keywords ---
+
+class MappedParagraphIndex:
+    """
+    Read-only location -> paragraph lookup backed by a memory-mapped file.
+
+    The data file holds every unique paragraph as UTF-8, back to back; the offsets file maps
+    each location to (byte offset, byte length). Worker processes map the same file, so the
+    paragraph text is shared through the OS page cache instead of being copied per process.
+    """
+
+    def __init__(self, data_path, offsets_path):
+        with open(offsets_path, 'r', encoding='utf-8') as f:
+            self.offsets = json.load(f)
+        self._file = open(data_path, 'rb')
+        # mmap cannot map an empty file
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(data_path) else b''
+
+    def get(self, location, default=None):
+        entry = self.offsets.get(location)
+        if entry is None:
+            return default
+        offset, length = entry
+        return self._map[offset:offset + length].decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets)
+
+def build_paragraph_index(workspace_dir):
+    """
+    Scans every keyword workspace once and writes a deduplicated paragraph index.
+    Returns (data_path, offsets_path).
+    """
+    data_path = os.path.join(workspace_dir, INDEX_DATA_FILENAME)
+    offsets_path = os.path.join(workspace_dir, INDEX_OFFSETS_FILENAME)
+    offsets = {}
+    position = 0
+
+    print("-> Building shared paragraph index across all keywords...")
+    with open(data_path, 'wb') as data_file, paragraph_store.ParagraphStore() as store:
+        for keyword in sorted(os.listdir(workspace_dir)):
+            keyword_dir = os.path.join(workspace_dir, keyword)
+            if not os.path.isdir(keyword_dir):
+                continue
+            for filename in jsonl_io.source_files(keyword_dir, keyword):
+                filepath = os.path.join(keyword_dir, filename)
+                if os.path.getsize(filepath) == 0:
+                    continue
+                try:
+                    for ref in store.iter_refs(filepath):
+                        if ref.location in offsets:
+                            continue
+                        encoded = store.get_text(ref.hash).encode('utf-8')
+                        data_file.write(encoded)
+                        offsets[ref.location] = (position, len(encoded))
+                        position += len(encoded)
+                except json.JSONDecodeError as e:
+                    print(f"  ! Warning: Skipping invalid JSON source file {filepath}: {e}")
+
+    with open(offsets_path, 'w', encoding='utf-8') as f:
+        json.dump(offsets, f, ensure_ascii=False)
 
-    print("\nSearching for final WikiText output files to validate...")
-    files_to_validate = []
-    file_pattern_end = f'_{keyword}.txt'
-    for filename in os.listdir(project_root):
-        if filename.startswith('final_output_') and filename.endswith(file_pattern_end):
-             files_to_validate.append(os.path.join(project_root, filename))
+    print(f"  -> Indexed {len(offsets)} unique paragraphs ({position / 1_000_000:.1f} MB).")
+    return data_path, offsets_path
 
+_worker_index = None
+
+def _init_worker(data_path, offsets_path):
+    global _worker_index
+    _worker_index = MappedParagraphIndex(data_path, offsets_path)
+
+def _validate_file_in_worker(file_path):
+    return file_path, _validate_and_update_wikitext_file(file_path, _worker_index)
+
+def validate_all(workers=None):
+    """
+    Validates every final_output_*.txt file in the project root in parallel, against a
+    single index built from all keyword workspaces, and writes a consolidated report.
+    """
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workspace_dir = os.path.join(project_root, 'workspace')
+
+    files_to_validate = sorted(
+        os.path.join(project_root, f) for f in os.listdir(project_root)
+        if f.startswith('final_output_') and f.endswith('.txt')
+    )
     if not files_to_validate:
-        print(f"\n!!! ERROR: No final output files found for keyword '{keyword}' in root directory.")
-        print("    Example expected filename: 'final_output_ChatGPT_power.txt'")
+        print("!!! ERROR: No final output files found in root directory.")
         return
 
-    for file_path in files_to_validate:
-        if os.path.exists(file_path):
-            _validate_and_update_wikitext_file(file_path, original_quotes)
+    data_path, offsets_path = build_paragraph_index(workspace_dir)
+
+    report = {"files": {}, "total_mismatches": 0, "total_repairs": 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(data_path, offsets_path)) as executor:
+        for file_path, (mismatches, repairs) in executor.map(_validate_file_in_worker, files_to_validate):
+            report["files"][os.path.basename(file_path)] = {"mismatches": mismatches, "repairs": repairs}
+            report["total_mismatches"] += len(mismatches)
+            report["total_repairs"] += len(repairs)
+
+    report_path = os.path.join(project_root, REPORT_FILENAME)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\n-> Validated {len(files_to_validate)} files; {report['total_repairs']} excerpts repaired, "
+          f"{report['total_mismatches']} mismatches in total.")
+    print(f"-> Consolidated report saved to {report_path}")
 
 if __name__ == '__main__':
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    profile = profiling.pop_flag()
+    if len(sys.argv) >= 2 and sys.argv[1] == '--all':
+        workers = int(sys.argv[2]) if len(sys.argv) == 3 else None
+        if profile:
+            # Worker processes are not profiled; their time shows up as waiting
+            profiling.profile_script(None, 'validate-all')
+        validate_all(workers=workers)
+        sys.exit(0)
+
     if len(sys.argv) != 2:
-        print("Usage: python modules/validate_quotes.py <keyword>")
+        print("Usage: python modules/validate_quotes.py <keyword> [--profile]")
         print("  This will automatically find and validate all 'final_output_*_<keyword>.txt' files.")
+        print("       python modules/validate_quotes.py --all [workers] [--profile]")
+        print("  Validates every keyword's final output in parallel and writes validation_report.json.")
         sys.exit(1)
 
+    if profile:
+        profiling.profile_script(sys.argv[1], 'validate')
     validate(keyword=sys.argv[1])
@@ -0,0 +1,165 @@
+# modules/work_queue.py
+r"""
+Shared keyword x stage job queue with leases, so several machines can run the pipeline
+without two of them doing the same paid work.
+
+The queue is a SQLite database (default: workspace/work_queue.sqlite; override with
+WORK_QUEUE_PATH) on a filesystem every node can reach. A node claims a job by taking a
+lease on it inside an IMMEDIATE transaction, renews the lease with heartbeats while the
+stage runs, and marks it done when finished. If a node dies, its lease expires and another
+node picks the job up again, up to max_attempts.
+
+A keyword x stage is queued only once. To run a keyword again (after a failure, or for a
+--refresh later on), requeue() replaces its jobs from a given stage onwards.
+
+Note: SQLite relies on the filesystem's locking. Use a filesystem with working POSIX locks
+(e.g. a local disk exported over SMB/NFSv4 with locking enabled); NFSv3 without lockd is
+not safe.
+"""
+
+import os
+import time
+import sqlite3
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+def default_queue_path():
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return os.getenv("WORK_QUEUE_PATH") or os.path.join(project_root, 'workspace', 'work_queue.sqlite')
+
+class WorkQueue:
+    def __init__(self, path=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path or default_queue_path()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # isolation_level=None: transactions are managed explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                keyword TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                refresh INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (keyword, stage)
+            )
+        """)
+        # Queues created before requeue() existed have no refresh column
+        columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if 'refresh' not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN refresh INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, keyword, stage, refresh=False):
+        """Adds a job unless the same keyword x stage is already queued (or done)."""
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO jobs (keyword, stage, refresh, updated_at) VALUES (?, ?, ?, ?)",
+            (keyword, stage, int(refresh), time.time()))
+        return cursor.rowcount == 1
+
+    def requeue(self, keyword, stages, refresh=False, on_reset=None):
+        """
+        Deletes the keyword's jobs for `stages` (whatever their status) and queues the first
+        of them again; the others follow as each one completes. Returns False, changing
+        nothing, while one of those jobs is leased to a live node.
+
+        `on_reset()` (e.g. deleting stage markers) runs while the queue is locked, so no node
+        can claim the new job before it has finished.
+        """
+        now = time.time()
+        placeholders = ', '.join('?' * len(stages))
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            running = self.conn.execute(
+                f"SELECT COUNT(*) FROM jobs WHERE keyword = ? AND stage IN ({placeholders}) "
+                "AND status = 'leased' AND lease_expires >= ?",
+                (keyword, *stages, now)).fetchone()[0]
+            if running:
+                self.conn.execute("COMMIT")
+                return False
+            self.conn.execute(f"DELETE FROM jobs WHERE keyword = ? AND stage IN ({placeholders})", (keyword, *stages))
+            if on_reset:
+                on_reset()
+            self.enqueue(keyword, stages[0], refresh)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def claim(self, owner):
+        """Leases the oldest available job to `owner`. Returns the job row, or None."""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs whose last lease expired after the final attempt are given up on
+            self.conn.execute(
+                "UPDATE jobs SET status = 'failed', last_error = COALESCE(last_error, 'Lease expired'), updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts))
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                "AND attempts < ? ORDER BY id LIMIT 1",
+                (now, self.max_attempts)).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ?",
+                (owner, now + self.lease_seconds, now, row['id']))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return self.get(row['id'])
+
+    def heartbeat(self, job_id, owner):
+        """Extends the lease. Returns False if the lease has been lost to another node."""
+        now = time.time()
+        cursor = self.conn.execute(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = 'leased'",
+            (now + self.lease_seconds, now, job_id, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, owner, next_stage=None):
+        """Marks the job done and queues the keyword's next stage. Returns False if the lease was lost."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = 'done', lease_expires = NULL, last_error = NULL, updated_at = ? "
+                "WHERE id = ? AND owner = ? AND status = 'leased'",
+                (time.time(), job_id, owner))
+            if cursor.rowcount == 1 and next_stage:
+                job = self.get(job_id)
+                self.enqueue(job['keyword'], next_stage, job['refresh'])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, owner, error):
+        """Releases the job for a retry, or marks it failed once max_attempts is reached."""
+        self.conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "owner = NULL, lease_expires = NULL, last_error = ?, updated_at = ? "
+            "WHERE id = ? AND owner = ? AND status = 'leased'",
+            (self.max_attempts, str(error), time.time(), job_id, owner))
+
+    def get(self, job_id):
+        row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def jobs(self):
+        return [dict(row) for row in self.conn.execute("SELECT * FROM jobs ORDER BY keyword, id")]
@@ -0,0 +1,198 @@
+r"""
+Distributed execution: several machines pull keyword x stage jobs from a shared queue.
+
+Every node runs `work` against the same queue database (see modules/work_queue.py) and
+the same project directory (workspace/ on a shared filesystem). Each stage of a keyword is
+a separate job; finishing one queues the next, so different stages of different keywords
+run on different nodes at the same time.
+
+A stage writes workspace/<keyword>/.stage-<stage>.done when it finishes. A job whose
+marker already exists (e.g. a node finished the work but died before reporting it) is
+completed without running the stage again, so paid API work is never repeated.
+
+If a node loses its lease while a stage runs (its heartbeats failed long enough for another
+node to claim the job), the stage is interrupted at the next point it returns to Python
+code, i.e. after the request or pause in progress, so the two nodes never keep paying for
+the same work.
+
+`requeue` runs keywords again: it replaces their jobs from a stage onwards (default: all
+stages) and deletes those stages' markers. With --refresh, the stages run in refresh mode
+(see modules/refresh.py).
+
+Usage:
+    python queue_worker.py enqueue <keyword> [<keyword> ...]
+    python queue_worker.py requeue <keyword> [<keyword> ...] [--from-stage <stage>] [--refresh]
+    python queue_worker.py work [--exit-when-idle]
+    python queue_worker.py status
+"""
+
+import os
+import sys
+import time
+import _thread
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+from dotenv import load_dotenv
+
+import main_process
+from modules import work_queue
+
+POLL_SECONDS = 15
+
+def stage_marker_path(keyword, stage):
+    return os.path.join('workspace', keyword, f'.stage-{stage}.done')
+
+def remove_stage_markers(keyword, stages):
+    for stage in stages:
+        marker_path = stage_marker_path(keyword, stage)
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+def _heartbeat_loop(job_id, owner, lease_seconds, stop_event, lease_lost):
+    """
+    Renews the lease every third of its length. When the lease is lost, sets `lease_lost` and
+    interrupts the main thread, which is running the stage.
+    """
+    # SQLite connections cannot be shared across threads, so the heartbeat uses its own
+    queue = work_queue.WorkQueue()
+    renewed_at = time.time()
+    try:
+        while not stop_event.wait(lease_seconds / 3):
+            try:
+                if queue.heartbeat(job_id, owner):
+                    renewed_at = time.time()
+                    continue
+                reason = "another node has claimed it"
+            except sqlite3.Error as e:
+                # Give up before the lease can expire, so no other node starts the same work meanwhile
+                if time.time() - renewed_at < lease_seconds * 2 / 3:
+                    print(f"  ! Could not renew the lease on job {job_id} ({e}); retrying.")
+                    continue
+                reason = f"the queue has been unreachable for too long ({e})"
+            if stop_event.is_set():
+                return
+            print(f"  ! Lost the lease on job {job_id}: {reason}. Stopping the stage.")
+            lease_lost.set()
+            _thread.interrupt_main()
+            return
+    finally:
+        queue.close()
+
+def run_job(job, owner, queue):
+    keyword, stage = job['keyword'], job['stage']
+    stage_index = main_process.STAGES.index(stage)
+    next_stage = main_process.STAGES[stage_index + 1] if stage_index + 1 < len(main_process.STAGES) else None
+    marker_path = stage_marker_path(keyword, stage)
+
+    print(f"[{owner}] Running '{stage}' for '{keyword}' (job {job['id']}, attempt {job['attempts']})")
+
+    stop_event = threading.Event()
+    lease_lost = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat_loop,
+                                 args=(job['id'], owner, queue.lease_seconds, stop_event, lease_lost), daemon=True)
+    heartbeat.start()
+
+    os.makedirs('logs', exist_ok=True)
+    log_file_path = os.path.join('logs', f'{keyword}.log')
+    try:
+        try:
+            with open(log_file_path, 'a', encoding='utf-8') as log_file:
+                if os.path.exists(marker_path):
+                    main_process.log_and_print(f"Stage '{stage}' already completed for '{keyword}'; skipping.", log_file)
+                else:
+                    main_process.run_stage(stage, keyword, log_file, log_file_path, refresh_mode=bool(job['refresh']))
+                    with open(marker_path, 'w', encoding='utf-8') as marker:
+                        marker.write(f"{owner} {time.time()}\n")
+        finally:
+            stop_event.set()
+            heartbeat.join()
+    except KeyboardInterrupt:
+        if not lease_lost.is_set():
+            raise
+        # The job belongs to another node now, so it is neither completed nor failed here
+        print(f"  ! Stopped '{stage}' for '{keyword}' after losing the lease on job {job['id']}.")
+        return
+    except SystemExit as e:
+        # The stages exit on fatal errors; the job is retried (or failed) instead
+        queue.fail(job['id'], owner, f"Stage exited with code {e.code}. See {log_file_path}")
+        return
+    except Exception as e:
+        traceback.print_exc()
+        queue.fail(job['id'], owner, repr(e))
+        return
+
+    if not queue.complete(job['id'], owner, next_stage):
+        print(f"  ! Job {job['id']} was claimed by another node just as this one finished; "
+              f"the other node will skip the stage if it sees the completion marker in time.")
+
+def work(exit_when_idle=False):
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    queue = work_queue.WorkQueue()
+    print(f"Worker {owner} polling {queue.path}")
+    while True:
+        job = queue.claim(owner)
+        if job is None:
+            if exit_when_idle:
+                print("Queue is empty. Exiting.")
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        run_job(job, owner, queue)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline from a shared multi-node work queue.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    enqueue_parser = subparsers.add_parser('enqueue', help="Queue keywords (starting at the search stage)")
+    enqueue_parser.add_argument('keywords', nargs='+')
+    requeue_parser = subparsers.add_parser('requeue', help="Run keywords again, including done or failed stages")
+    requeue_parser.add_argument('keywords', nargs='+')
+    requeue_parser.add_argument('--from-stage', choices=main_process.STAGES, default=main_process.STAGES[0],
+                                help="First stage to run again (default: search)")
+    requeue_parser.add_argument('--refresh', action='store_true',
+                                help="Run the stages in refresh mode (only new or changed paragraphs are paid for)")
+    work_parser = subparsers.add_parser('work', help="Claim and run jobs until stopped")
+    work_parser.add_argument('--exit-when-idle', action='store_true')
+    subparsers.add_parser('status', help="Show every job in the queue")
+    args = parser.parse_args()
+
+    # Stages use paths relative to the project root (logs/, workspace/, final_output_*)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    load_dotenv()
+
+    if args.command == 'enqueue':
+        queue = work_queue.WorkQueue()
+        for keyword in args.keywords:
+            added = queue.enqueue(keyword.lower(), main_process.STAGES[0])
+            print(f"{'Queued' if added else 'Already queued'}: {keyword.lower()}")
+    elif args.command == 'requeue':
+        queue = work_queue.WorkQueue()
+        stages = main_process.STAGES[main_process.STAGES.index(args.from_stage):]
+        for keyword in args.keywords:
+            keyword = keyword.lower()
+            if not queue.requeue(keyword, stages, refresh=args.refresh,
+                                 on_reset=lambda: remove_stage_markers(keyword, stages)):
+                print(f"Not requeued: {keyword} is running on another node. Try again when it has finished.")
+                continue
+            print(f"Requeued: {keyword} from '{args.from_stage}'{' in refresh mode' if args.refresh else ''}")
+    elif args.command == 'work':
+        work(args.exit_when_idle)
+    elif args.command == 'status':
+        queue = work_queue.WorkQueue()
+        jobs = queue.jobs()
+        if not jobs:
+            print("The queue is empty.")
+        for job in jobs:
+            line = f"[{job['id']}] {job['keyword']} / {job['stage']}: {job['status']} (attempts: {job['attempts']})"
+            if job['refresh']:
+                line += " [refresh]"
+            if job['status'] == 'leased':
+                line += f" by {job['owner']}, lease expires in {job['lease_expires'] - time.time():.0f}s"
+            if job['last_error']:
+                line += f" - {job['last_error']}"
+            print(line)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,226 @@
+r"""
+Long-running worker that keeps the pipeline warm between keyword runs.
+
+Starting main_process.py for every keyword re-imports openai and google.generativeai and
+rebuilds every client. The daemon imports them once, keeps the OpenAI client and the
+Gemini model handles (with their context caches) warm, and runs keyword jobs one at a
+time from a queue. Jobs are submitted and inspected over a small JSON API bound to localhost.
+
+Usage:
+    python worker_daemon.py serve [--port 8765]
+    python worker_daemon.py submit <keyword> [<keyword> ...] [--port 8765]
+    python worker_daemon.py status [job_id] [--port 8765]
+
+API:
+    POST /jobs          {"keyword": "government"}  -> job
+    GET  /jobs                                     -> all jobs
+    GET  /jobs/<id>                                -> one job
+
+POST requests must be sent as application/json. Browsers can only send that content type
+after a CORS preflight, which the daemon never answers, so web pages open on the same
+machine cannot start (paid) pipeline runs. Keywords may only contain letters, digits,
+underscores, spaces and hyphens, since they become file and directory names.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import traceback
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Keywords name logs/<keyword>.log and workspace/<keyword>/, so no path separators or dots
+KEYWORD_PATTERN = re.compile(r'[\w -]+')
+
+class JobQueue:
+    """Thread-safe job registry plus a single worker thread that runs the pipeline."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def submit(self, keyword):
+        with self.lock:
+            job_id = str(self.next_id)
+            self.next_id += 1
+            job = {
+                "id": job_id,
+                "keyword": keyword,
+                "status": "queued",
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "error": None,
+            }
+            self.jobs[job_id] = job
+        self.pending.put(job_id)
+        return dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def work_forever(self):
+        # Imported here, once, so the heavy provider SDKs load when the daemon starts
+        import main_process
+
+        while True:
+            job_id = self.pending.get()
+            keyword = self.jobs[job_id]["keyword"]
+            self._update(job_id, status="running", started_at=time.time())
+            try:
+                main_process.main(keyword)
+                self._update(job_id, status="done", finished_at=time.time())
+            except SystemExit as e:
+                # The pipeline stages exit on fatal errors; that must not kill the daemon
+                self._update(job_id, status="failed", finished_at=time.time(),
+                             error=f"Pipeline exited with code {e.code}. See logs/{keyword}.log")
+            except Exception as e:
+                traceback.print_exc()
+                self._update(job_id, status="failed", finished_at=time.time(), error=str(e))
+
+def make_handler(jobs):
+    class JobHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, indent=2).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = [p for p in self.path.split('/') if p]
+            if parts == ['jobs']:
+                self._send_json(200, jobs.list())
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                job = jobs.get(parts[1])
+                if job:
+                    self._send_json(200, job)
+                else:
+                    self._send_json(404, {"error": f"No job with id {parts[1]}"})
+            else:
+                self._send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/jobs':
+                self._send_json(404, {"error": "Not found"})
+                return
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type != 'application/json':
+                self._send_json(415, {"error": "Content-Type must be application/json"})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                keyword = request['keyword'].strip().lower()
+            except (ValueError, KeyError, AttributeError):
+                self._send_json(400, {"error": 'Expected a JSON body like {"keyword": "government"}'})
+                return
+            if not keyword:
+                self._send_json(400, {"error": "Keyword must not be empty"})
+                return
+            if not KEYWORD_PATTERN.fullmatch(keyword):
+                self._send_json(400, {"error": "Keyword may only contain letters, digits, underscores, spaces and hyphens"})
+                return
+            self._send_json(202, jobs.submit(keyword))
+
+    return JobHandler
+
+def serve(host, port):
+    # The pipeline uses paths relative to the project root (logs/, workspace/, final_output_*)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    jobs = JobQueue()
+    threading.Thread(target=jobs.work_forever, daemon=True).start()
+
+    server = ThreadingHTTPServer((host, port), make_handler(jobs))
+    print(f"Worker daemon listening on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down worker daemon.")
+    finally:
+        server.server_close()
+
+# --- CLI client ---
+
+def _request(method, url, payload=None):
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read())
+    except urllib.error.URLError as e:
+        print(f"Error: Could not reach the worker daemon at {url} ({e.reason}). Is it running?")
+        sys.exit(1)
+
+def _format_job(job):
+    line = f"[{job['id']}] {job['keyword']}: {job['status']}"
+    if job['started_at'] and job['finished_at']:
+        line += f" ({job['finished_at'] - job['started_at']:.0f}s)"
+    if job['error']:
+        line += f" - {job['error']}"
+    return line
+
+def main():
+    # Every command takes the address, after the command name: `serve --port 8799`
+    address_parser = argparse.ArgumentParser(add_help=False)
+    address_parser.add_argument('--host', default=DEFAULT_HOST)
+    address_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+
+    parser = argparse.ArgumentParser(description="Persistent worker for the CreatePages-AI pipeline.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', parents=[address_parser], help="Start the worker daemon")
+    submit_parser = subparsers.add_parser('submit', parents=[address_parser], help="Queue one or more keywords")
+    submit_parser.add_argument('keywords', nargs='+')
+    status_parser = subparsers.add_parser('status', parents=[address_parser], help="Show all jobs, or one job")
+    status_parser.add_argument('job_id', nargs='?')
+    args = parser.parse_args()
+
+    base_url = f"http://{args.host}:{args.port}"
+
+    if args.command == 'serve':
+        serve(args.host, args.port)
+    elif args.command == 'submit':
+        for keyword in args.keywords:
+            job = _request('POST', f"{base_url}/jobs", {"keyword": keyword})
+            print(_format_job(job) if 'id' in job else f"Error: {job.get('error')}")
+    elif args.command == 'status':
+        if args.job_id:
+            job = _request('GET', f"{base_url}/jobs/{args.job_id}")
+            print(_format_job(job) if 'id' in job else f"Error: {job.get('error')}")
+        else:
+            jobs = _request('GET', f"{base_url}/jobs")
+            if not jobs:
+                print("No jobs submitted yet.")
+            for job in jobs:
+                print(_format_job(job))
+
+if __name__ == "__main__":
+    main()